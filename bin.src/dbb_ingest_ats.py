@@ -26,21 +26,37 @@ in the delivery directory by dbb_save_ats_raw.py into the Data Backbone
 """
 
 import argparse
+import atexit
+import contextlib
+import errno
 import logging
-import glob
+import mmap
+import multiprocessing
+import multiprocessing.util
 import os
+import queue
 import sys
+import threading
 import time
 import re
 import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime, timedelta
 import tarfile
 import tempfile
 import shutil
-import pyfits
 import yaml
-
-from lsst.dbb.gwclient import chksum_utils
+from astropy.io import fits
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
+from lsst.dbb.gateway import chksum_funcs
 from lsst.dbb.gateway import db_funcs
 
 # Current code constraints:
@@ -49,7 +65,34 @@ from lsst.dbb.gateway import db_funcs
 
 
 DEFAULT_MV_TRIES = 5
+DEFAULT_COMMIT_EVERY = 50
+FITS_CARD_LEN = 80
+FITS_END_CARD = b"END".ljust(FITS_CARD_LEN)
+PATH_VAR_RE = re.compile(r"\{([^{}]+)\}")
 DUPLICATE_MSG = "Duplicate file"
+# os.link errors meaning the file must be copied instead (different
+# filesystems, or a filesystem without (more) hard links)
+LINK_FALLBACK_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EMLINK}
+
+LOG_FORMAT = "%(levelname)s::%(asctime)s::%(message)s"
+LOG_DATEFMT = "%m/%d/%Y %H:%M:%S"
+
+# worker processes are started fresh instead of forked, as forking would copy
+# the parent's OCI session pool and connection (OCI is not fork-safe) and any
+# lock held by the scratch cleanup thread
+WORKER_START_METHOD = "spawn"
+
+_log = logging.getLogger(__name__)
+
+# DB connection owned by a worker process when ingesting in parallel
+_worker_dbh = None
+
+# serializes finding/creating the registration process of a uuid (replaced by
+# a lock shared by all the worker processes when ingesting in parallel)
+_registration_lock = threading.Lock()
+
+# scratch directories waiting to be removed by the cleanup thread
+_cleanup_queue = queue.Queue()
 
 
 def read_config(filename):
@@ -66,8 +109,13 @@ def read_config(filename):
         Dictionary containing configuration loaded from the yaml file
     """
     with open(filename, "r") as cfgfh:
-        config = yaml.load(cfgfh)
-    logging.debug(config)
+        config = yaml.load(cfgfh, Loader=YamlLoader)
+    if _log.isEnabledFor(logging.DEBUG):
+        _log.debug(config)
+
+    # patterns are fixed for the run, so only find their variables once
+    config["_dir_pattern_vars"] = {dstype: (frozenset(get_path_var_names(pattern)), pattern)
+                                   for dstype, pattern in config["dir_patterns"].items()}
     return config
 
 
@@ -97,58 +145,56 @@ def parse_args(argv=None):
                         help="If set, does not actually ingest file")
     parser.add_argument("--keep", action="store_true", dest="keep", required=False,
                         help="If set, scratch directory not deleted")
+    parser.add_argument("-j", "--jobs", type=int, dest="jobs", required=False, default=1,
+                        help="Number of tarballs to ingest in parallel")
 
     return parser.parse_args(argv)
 
 
-def get_camera_name(hdu):
+def get_camera_name(header):
     """Creates short camera name from the INSTRUME fits keyword
 
     Parameters
     ----------
-    hdu : `pyfits.HDU`
-        HDU containing the INSTRUME keyword
+    header : `dict`-like
+        FITS header containing the INSTRUME keyword
 
     Returns
     -------
     short_camera_name: `str`
         A string containing the short camera name
     """
-    instrument = hdu.header["instrume"]
+    instrument = header["INSTRUME"]
     short_camera_name = {"Hyper Suprime-Cam": "HSC",
                          "ATSCAM": "ATS"}
 
     return short_camera_name[instrument]
 
 
-def get_observing_nite(hdu):
+def get_observing_nite(header):
     """Get observing nite string from fits header or create it from
        date-obs value
 
     Parameters
     ----------
-    hdu : `pyfits.HDU`
-        HDU containing the DATE-OBS keyword
+    header : `dict`-like
+        FITS header containing the DATE-OBS keyword
 
     Returns
     -------
     nite : `str`
         A string containing the observing nite (YYYYMMDD)
     """
-    if "obs-nite" in hdu.header:
-        nite = hdu.header["obs-nite"]
-    else:
-        # date_obs = "YYYY-MM-DDTHH:MM:SS.S"
-        date_obs = hdu.header["date-obs"]
-        try:
-            obs_datetime = datetime.strptime(date_obs, "%Y-%m-%dT%%H:%M:%S.%f")
-            if obs_datetime.hour < 14:
-                obs_datetime = obs_datetime - timedelta(days=1)
-        except ValueError:
-            obs_datetime = datetime.strptime(date_obs, "%Y-%m-%d")
+    nite = header.get("OBS-NITE")
+    if nite is None:
+        # date_obs = "YYYY-MM-DDTHH:MM:SS.S" or "YYYY-MM-DD" (fixed width)
+        date_obs = header["DATE-OBS"]
+        obs_datetime = datetime(int(date_obs[0:4]), int(date_obs[5:7]), int(date_obs[8:10]))
+        if len(date_obs) > 10 and int(date_obs[11:13]) < 14:
+            obs_datetime = obs_datetime - timedelta(days=1)
 
         nite = obs_datetime.strftime("%Y%m%d")
-    logging.debug("nite = %s", nite)
+    _log.debug("nite = %s", nite)
     return nite
 
 
@@ -166,20 +212,56 @@ def get_path_var_names(pattern):
     patvars : `set`
         A set containing the variable names found in the path pattern
     """
-    patvars = re.findall("{([^{}]+)}", pattern)
+    patvars = PATH_VAR_RE.findall(pattern)
     patvars = [x.split(":")[0] for x in patvars]
     return set(patvars)
 
 
-def create_rel_path(filename, pattern):
+def read_fits_header(source):
+    """Read the primary header of a FITS file without loading any data
+
+    Parameters
+    ----------
+    source : `str` or buffer
+        Name of the FITS file, includes path if needed to open file, or
+        a buffer (e.g., `mmap.mmap`) holding the file contents
+
+    Returns
+    -------
+    header : `dict`-like
+        The primary HDU header (`fitsio.FITSHDR` if reading a file and
+        fitsio is available, otherwise `astropy.io.fits.Header`)
+
+    Raises
+    ------
+    ValueError
+        Raised if source is a buffer that does not contain an END card
+    """
+    if isinstance(source, str):
+        if fitsio is not None:
+            return fitsio.read_header(source, 0)
+        return fits.getheader(source, 0)
+
+    # END card must start on a card boundary
+    end = source.find(FITS_END_CARD)
+    while end != -1 and end % FITS_CARD_LEN:
+        end = source.find(FITS_END_CARD, end + 1)
+    if end == -1:
+        raise ValueError("Could not find END card in primary FITS header")
+    return fits.Header.fromstring(bytes(source[:end + FITS_CARD_LEN]))
+
+
+def create_rel_path(header, pattern, varnames=None):
     """Creates the relative path for the given file using given pattern
 
     Parameters
     ----------
-    filename : `str`
-        Name of the file, includes path if needed to open file
+    header : `dict`-like
+        Primary FITS header of the file
     pattern : `str`
         Pattern for the relative path, variables are {varname}
+    varnames : `set`, optional
+        Variable names in pattern if already known (see get_path_var_names)
 
     Returns
     -------
@@ -187,31 +269,30 @@ def create_rel_path(filename, pattern):
         The pattern string with the variable names replaced by their values
     """
     # get variable names needed to fill pattern
-    logging.debug("dir pattern = %s", pattern)
-    varnames = get_path_var_names(pattern)
-    logging.debug("pat vars = %s", varnames)
+    _log.debug("dir pattern = %s", pattern)
+    if varnames is None:
+        varnames = get_path_var_names(pattern)
+    _log.debug("pat vars = %s", varnames)
 
     # get values needed in order to replace variables
     calc_vals = {"obsnite": get_observing_nite,
                  "camera": get_camera_name}
     vals = {}
-    hdulist = pyfits.open(filename, "readonly")
     for name in varnames:
         if name in calc_vals:
-            vals[name] = calc_vals[name](hdulist[0])
+            vals[name] = calc_vals[name](header)
         else:
-            vals[name] = hdulist[0].header[name]
-    hdulist.close()
+            vals[name] = header[name.upper()]
 
     # replace variable names with values in pattern
-    logging.debug("pat vals = %s", vals)
+    _log.debug("pat vals = %s", vals)
     relpath = pattern.format(**vals)
-    logging.debug("relpath = %s", relpath)
+    _log.debug("relpath = %s", relpath)
 
     return relpath
 
 
-def create_dbb_path(config, src_info):
+def create_dbb_path(config, src_info, header):
     """Creates the path for the location of the given file inside the DBB
 
     Parameters
@@ -221,6 +302,8 @@ def create_dbb_path(config, src_info):
     src_info : `dict`
         Dictionary containing information about the file, includes
         filename, dataset_type, expected chksum, chksum_type
+    header : `dict`-like
+        Primary FITS header of the file
 
     Returns
     -------
@@ -230,54 +313,183 @@ def create_dbb_path(config, src_info):
         String containing the full path for the file in the DBB, including DBB root and filename
     """
     # get relative path inside DBB based upon pattern
-    dir_pattern = config["dir_patterns"][src_info["dataset_type"]]
-    dbb_rel_path = create_rel_path(src_info["filename"], dir_pattern)
+    varnames, dir_pattern = config["_dir_pattern_vars"][src_info["dataset_type"]]
+    dbb_rel_path = create_rel_path(header, dir_pattern, varnames)
 
     # create full filename including DBB root and relative path
     dbb_root = config["dbb_root_dir"]
     dbb_path = "%s/%s" % (dbb_root, dbb_rel_path)
     basename = os.path.basename(src_info["filename"])
     dbb_fullname = "%s/%s" % (dbb_path, basename)
-    logging.debug("%s -> %s", src_info["filename"], dbb_fullname)
+    _log.debug("%s -> %s", src_info["filename"], dbb_fullname)
 
     return dbb_rel_path, dbb_fullname
 
 
-def save_file_datastore(dbh, config, src_info, dataset_id):
-    """Save file into datastore moving file and making DB entries
+def save_file_datastore(config, src_info, header, src):
+    """Save file into datastore on disk (DB entries are made by save_batch_db)
 
     Parameters
     ----------
-    dbh : `cx_Oracle.Connection`
-        Open database connection with write access to DBB tables
     config : `dict`
         Dictionary containing program configuration options
     src_info : `dict`
         Dictionary containing information about file
-    dataset_id : `int`
-        Dataset id corresponding to dataset information stored in DBB's registry
+    header : `dict`-like
+        Primary FITS header of the file
+    src : `str`
+        Name of the file to move to the DBB, including path
 
     Returns
     -------
+    dbb_relpath : `str`
+        The path for the file in the DBB, relative to the DBB root
     dbb_fullname : `str`
         The filename for the file in the DBB with path that includes DBB root
+
+    Raises
+    ------
+    FileExistsError
+        Raised if the file already exists on disk in the DBB
     """
     # figure out where to save it in DBB
-    dbb_relpath, dbb_fullname = create_dbb_path(config, src_info)
-    logging.debug("dbb_fullname = %s", dbb_fullname)
+    dbb_relpath, dbb_fullname = create_dbb_path(config, src_info, header)
+    _log.debug("dbb_fullname = %s", dbb_fullname)
+
+    # move file to the DBB location, error if file already exists in DBB datastore
+    try:
+        move_file_to_dbb(src, src_info["chksum"], src_info["chksum_type"],
+                         dbb_fullname, DEFAULT_MV_TRIES)
+    except FileExistsError as err:
+        raise FileExistsError("Consistency error.  Already on disk in DBB") from err
+
+    return dbb_relpath, dbb_fullname
+
+
+def save_batch_db(dbh, config, batch, retry_timeout=True):
+    """Make the DB entries for a batch of files already moved into the DBB
+       and commit them all at once
+
+    Parameters
+    ----------
+    dbh : `cx_Oracle.Connection`
+        Open database connection with write access to DBB tables
+    config : `dict`
+        Dictionary containing program configuration options
+    batch : `list` [`dict`]
+        Files returned by handle_tarball, each containing src_info,
+        relpath and fullname (the filename in the DBB including DBB root)
+    retry_timeout : `bool`
+        If True, the batch is saved again once if a DB call times out
+
+    Notes
+    -----
+    Datastore rows are merged so a filename already in the DBB is reported
+    instead of inserted, and the UNIQUE constraint on datastore_dbb.filename
+    catches concurrent duplicates.  Files whose datastore rows cannot be inserted
+    (duplicates or other row errors) are removed from the DBB and their
+    tarballs moved to the bad file area, then the rest of the batch is
+    saved again.  If saving the batch to the DB fails for any other
+    reason, every file in the batch is removed from the DBB and its
+    tarball is moved to the bad file area.  Otherwise the tarballs are
+    removed from the delivery area.
+    """
+    if not batch:
+        return
+
+    try:
+        start_time = datetime.now()
+        # dataset rows, datastore rows and process end times in one round-trip
+        row_errors = db_funcs.save_batch(dbh, [(entry["src_info"], entry["relpath"]) for entry in batch])
+
+        if not row_errors:
+            _log.debug("%s files: registering file data (%0.2f secs)", len(batch),
+                       (datetime.now() - start_time).total_seconds())
+            _log.debug("%s files: success.  committing to db", len(batch))
+            db_funcs.commit_batch(dbh)
+    except SyntaxError:   # assuming this is program problem and not data problem
+        raise
+    except Exception as err:
+        if db_funcs.is_connection_broken(err):
+            # cannot roll back or save bad file info, main removes the batch's files
+            _log.error("Lost DB connection saving batch of %s files: %s", len(batch), err)
+            raise
+
+        # undo any pending database changes for this batch
+        dbh.rollback()
+
+        if retry_timeout and db_funcs.is_timeout(err):
+            _log.warning("Timed out saving batch of %s files, retrying: %s", len(batch), err)
+            save_batch_db(dbh, config, batch, retry_timeout=False)
+            return
+
+        if db_funcs.is_unique_violation(err):
+            if len(batch) > 1:
+                for entry in batch:
+                    save_batch_db(dbh, config, [entry])
+                return
+            _log.debug("Non-unique filename = %s", batch[0]["src_info"]["filename"])
+            msg = DUPLICATE_MSG
+        else:
+            (extype, exvalue, trback) = sys.exc_info()
+            print("******************************")
+            print("Error: saving batch of %s files" % len(batch))
+            traceback.print_exception(extype, exvalue, trback, file=sys.stdout)
+            print("******************************")
+            msg = "%s: %s" % (type(err).__name__, str(err))
+
+        for entry in batch:
+            _log.warning("Removing bad file from dbb = %s", entry["fullname"])
+            os.remove(entry["fullname"])
+            handle_bad_file(config, dbh, entry["src_info"]["tar_filename"], entry["src_info"], msg)
+        db_funcs.commit_batch(dbh)
+        return
+
+    if row_errors:
+        # nothing from a batch is committed unless every row is saved
+        dbh.rollback()
+        failed = {}
+        for error in row_errors:
+            if error.code == 1:
+                _log.debug("Non-unique filename = %s", batch[error.offset]["src_info"]["filename"])
+                failed[error.offset] = DUPLICATE_MSG
+            else:
+                failed[error.offset] = "DatabaseError: %s" % error.message
+        for offset, msg in failed.items():
+            entry = batch[offset]
+            _log.warning("Removing bad file from dbb = %s", entry["fullname"])
+            os.remove(entry["fullname"])
+            handle_bad_file(config, dbh, entry["src_info"]["tar_filename"], entry["src_info"], msg)
+        db_funcs.commit_batch(dbh)
+        save_batch_db(dbh, config, [entry for offset, entry in enumerate(batch) if offset not in failed])
+        return
+
+    # the batch is committed, so failing to remove a tarball must not stop the run
+    # (it would be rejected as a duplicate by a later run)
+    for entry in batch:
+        try:
+            os.remove(entry["src_info"]["tar_filename"])
+        except OSError as err:
+            _log.warning("Could not remove ingested tarball %s: %s", entry["src_info"]["tar_filename"], err)
 
-    # error if file already exists in DBB datastore
-    if os.path.exists(dbb_fullname):
-        handle_bad_file(config, dbh, src_info, "Consistency error.  Already on disk in DBB")
 
-    # move file to the DBB location
-    move_file_to_dbb(src_info["filename"], src_info["chksum"], src_info["chksum_type"],
-                     dbb_fullname, DEFAULT_MV_TRIES)
+def undo_batch(batch):
+    """Remove from the DBB the files whose DB entries were never saved
 
-    # save physical and location information in DBB tables
-    db_funcs.save_datastore_info(dbh, src_info, dbb_relpath, dataset_id)
+    Parameters
+    ----------
+    batch : `list` [`dict`]
+        Files returned by handle_tarball, see save_batch_db
 
-    return dbb_fullname
+    Notes
+    -----
+    Used when the program stops before a batch is saved.  The tarballs
+    are left in the delivery area so the files are ingested by the next run.
+    """
+    for entry in batch:
+        if entry["fullname"] is not None and os.path.exists(entry["fullname"]):
+            _log.warning("Removing unsaved file from dbb = %s", entry["fullname"])
+            os.remove(entry["fullname"])
 
 
 def move_file_to_dbb(src, expected_chksum, chksum_type, dst, max_tries=DEFAULT_MV_TRIES):
@@ -299,35 +511,58 @@ def move_file_to_dbb(src, expected_chksum, chksum_type, dst, max_tries=DEFAULT_M
     ------
     IOError
         Raised if cannot copy file after max_tries
+    FileExistsError
+        Raised if dst already exists (never overwritten)
     """
-    logging.debug("src = %s", src)
-    logging.debug("dst = %s", dst)
+    _log.debug("src = %s", src)
+    _log.debug("dst = %s", dst)
+
+    # if on same filesystem, a hard link moves the file without copying any
+    # bytes (unlike rename, link fails instead of replacing an existing dst)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        raise
+    except OSError as err:
+        if err.errno not in LINK_FALLBACK_ERRNOS:
+            raise
+        _log.info("Cannot link (%s, %s): %s, copying instead", src, dst, err.strerror)
+    else:
+        os.unlink(src)
+        if expected_chksum is not None:
+            actual_chksum = chksum_funcs.calc_chksum(name=dst, chksum_type=chksum_type)
+            if expected_chksum != actual_chksum:
+                os.unlink(dst)   # remove bad file from dbb
+                raise IOError("chksum does not match after move (%s->%s)" % (src, dst))
+        return
 
     # try a couple times to copy file to dbb directory
     cp_cnt = 1
     copied = False
     while cp_cnt <= max_tries and not copied:
         try:
-            os.makedirs(os.path.dirname(dst), exist_ok=True)
-            shutil.copy2(src, dst)  # similar to cp -p
-
+            # similar to cp -p, calculating chksum while copying if it will be checked
             starttime = datetime.now()
-            actual_chksum = chksum_utils.calc_chksum(name=dst, chksum_type=chksum_type)
+            actual_chksum = chksum_funcs.copy_and_hash(src, dst,
+                                                       None if expected_chksum is None else chksum_type)
             endtime = datetime.now()
-            logging.debug("%s: chksum after move %s (%0.2f secs)", dst, actual_chksum,
-                          (endtime - starttime).total_seconds())
+            _log.debug("%s: chksum during copy %s (%0.2f secs)", dst, actual_chksum,
+                       (endtime - starttime).total_seconds())
 
             if expected_chksum is None:
                 copied = True
             elif expected_chksum != actual_chksum:
-                logging.warning("chksum does not match after cp (%s, %s)", src, dst)
+                _log.warning("chksum does not match after cp (%s, %s)", src, dst)
                 time.sleep(5)
                 os.unlink(dst)   # remove bad file from dbb
                 cp_cnt += 1
             else:
                 copied = True
+        except FileExistsError:   # never remove a file already in the dbb
+            raise
         except IOError as err:  # Want to retry in case intermittent IOError
-            logging.info("Caught %s: %s", type(err).__name__, str(err))
+            _log.info("Caught %s: %s", type(err).__name__, str(err))
             time.sleep(5)
             if os.path.exists(dst):
                 os.unlink(dst)   # remove bad file from dbb
@@ -340,117 +575,202 @@ def move_file_to_dbb(src, expected_chksum, chksum_type, dst, max_tries=DEFAULT_M
     os.unlink(src)
 
 
-def read_info_file(info_fname):
-    """Read the file containing physical and provenance information
-       about file known when file was originally saved.
+def read_info(info_data):
+    """Parse the contents of the info file containing physical and provenance
+       information about file known when file was originally saved.
 
     Parameters
     ----------
-    info_fname : `str`
-        Name of the file, including any necessary paths
+    info_data : `bytes` or `str`
+        Contents of the info file (yaml format)
 
     Returns
     -------
     src_info : `dict`
         Dictionary containing information about file
     """
-    with open(info_fname, "r") as infofh:
-        src_info = yaml.load(infofh)
-    logging.debug("src_info = %s", src_info)
+    src_info = yaml.load(info_data, Loader=YamlLoader)
+    if _log.isEnabledFor(logging.DEBUG):
+        _log.debug("src_info = %s", src_info)
     return src_info
 
 
 def handle_tarball(tar_filename, scratch_dir, dbh, config):
-    """Performs steps necessary for each file
+    """Performs steps necessary for each file before its DB entries are
+       saved with the rest of its batch
 
     Parameters
     ----------
     tar_filename : `str`
         The tarball filname including the path to the delivery area.
     scratch_dir : `str`
-        The scratch directory where the tarball should be extracted
+        The scratch directory where the raw file should be extracted
     dbh : `cx_Oracle.Connection`
         Open database connection with write access to DBB tables
     config : `dict`
         Dictionary containing program configuration options
 
-    Raises
-    ------
-    ValueError
-        Raised when an internal consistency check failed because two
-        copies of a chksum value do not match
+    Returns
+    -------
+    entry : `dict` or None
+        Information needed by save_batch_db (src_info, relpath and
+        fullname) for a file moved into the DBB, None if the tarball
+        was skipped or rejected.  If the file's DBB path already exists,
+        fullname is None and exists_msg describes the error (see
+        handle_existing_file).
     """
     dbb_fullname = None
     src_info = None
+    entry = None
 
     try:
-        logging.debug("tar_filename = %s", tar_filename)
+        _log.debug("tar_filename = %s", tar_filename)
 
         if not os.path.exists(tar_filename):
-            logging.warning("tarball does not exist = %s.   Skipping", tar_filename)
-            return
+            _log.warning("tarball does not exist = %s.   Skipping", tar_filename)
+            return None
 
-        untar2dir(tar_filename, scratch_dir)
+        filename, data_fname, info_fname, info_data, digest_data = read_tarball(tar_filename,
+                                                                                scratch_dir)
 
-        os.chdir(scratch_dir)
-        filename, info_fname, digest_fname = get_filenames()
+        digest = read_digest(digest_data)
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug("digest = %s", digest)
 
-        with open(digest_fname, "r") as digestfh:
-            digest = read_digest(digestfh)
-        logging.debug("digest = %s", digest)
+        integrity_check(info_fname, digest[info_fname], data=info_data)
 
-        integrity_check(info_fname, digest[info_fname])
-        integrity_check(filename, digest[filename])
-
-        src_info = read_info_file(info_fname)
+        src_info = read_info(info_data)
         src_info["tar_filename"] = tar_filename
 
+        # map the data file once so the chksum and the header both come from a single read
+        with open(data_fname, "rb") as datafh, \
+                mmap.mmap(datafh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            integrity_check(filename, digest[filename], src_info["chksum_type"], data=data)
+            header = read_fits_header(data)
+
         # Internal consistency test
         if digest[filename] != src_info["chksum"]:
             raise ValueError("Internal consistency check failed. chksum values do not match for %s" %
                              filename)
 
-        process_id = db_funcs.get_registration_process_id(dbh, src_info['uuid'])
-        if process_id is None:
-            process_id = db_funcs.save_registration_info(dbh, src_info)
-        logging.debug("Registration process id = %s", process_id)
+        process_id = get_registration_process(dbh, src_info)
+        _log.debug("Registration process id = %s", process_id)
         src_info["process_id"] = process_id
 
-        if db_funcs.filename_exists_in_dbb(dbh, src_info["filename"]):
-            logging.debug("Non-unique filename = %s", src_info["filename"])
-            handle_bad_file(config, dbh, src_info, DUPLICATE_MSG)
-        else:
-            start_time = datetime.now()
-            dataset_id = db_funcs.register_file_data(dbh, src_info)
-            logging.debug("%s: gathering and registering file data (%0.2f secs)",
-                          src_info["filename"], (datetime.now() - start_time).total_seconds())
-
-            dbb_fullname = save_file_datastore(dbh, config, src_info, dataset_id)
-            logging.debug("%s: fullname in dbb %s", src_info["filename"], dbb_fullname)
-
-            logging.debug("%s: success.  committing to db", src_info["filename"])
-            os.remove(tar_filename)
-            db_funcs.save_end_time(dbh, process_id)
-            dbh.commit()
+        # duplicate filenames are caught when the batch is saved (see save_batch_db),
+        # except for a resent file, which has the same DBB path as the original.
+        # The original may be in the caller's batch, not yet in the DB.
+        try:
+            dbb_relpath, dbb_fullname = save_file_datastore(config, src_info, header, data_fname)
+        except FileExistsError as err:
+            return {"src_info": src_info, "relpath": None, "fullname": None,
+                    "exists_msg": "%s: %s" % (type(err).__name__, str(err))}
+        _log.debug("%s: fullname in dbb %s", src_info["filename"], dbb_fullname)
+        entry = {"src_info": src_info, "relpath": dbb_relpath, "fullname": dbb_fullname}
 
     except SyntaxError:   # assuming this is program problem and not data problem
         raise
     except Exception as err:
+        if db_funcs.is_connection_broken(err):
+            # cannot roll back or save bad file info, leave the tarball to be ingested again
+            if dbb_fullname is not None:
+                os.remove(dbb_fullname)
+            raise
+
         (extype, exvalue, trback) = sys.exc_info()
         print("******************************")
         print("Error: %s" % tar_filename)
         traceback.print_exception(extype, exvalue, trback, file=sys.stdout)
         print("******************************")
+        bad_msg = "%s: %s" % (type(err).__name__, str(err))
 
         # undo any pending database changes for this file
         dbh.rollback()
 
         # if error happened after copying file to DBB location, need to remove it from DBB
         if dbb_fullname is not None:
-            logging.warning("Removing bad file from dbb = %s", dbb_fullname)
+            _log.warning("Removing bad file from dbb = %s", dbb_fullname)
             os.remove(dbb_fullname)
 
-        handle_bad_file(config, dbh, src_info, "%s: %s" % (type(err).__name__, str(err)))
+        handle_bad_file(config, dbh, tar_filename, src_info, bad_msg)
+        db_funcs.commit_batch(dbh)
+
+    return entry
+
+
+def handle_existing_file(config, dbh, entry, pending_filenames):
+    """Reject a file whose DBB path already exists (see handle_tarball)
+
+    Parameters
+    ----------
+    config : `dict`
+        Dictionary containing program configuration options
+    dbh : `cx_Oracle.Connection`
+        Open database connection with write access to DBB tables
+    entry : `dict`
+        Entry returned by handle_tarball with fullname None
+    pending_filenames : `set` [`str`]
+        Filenames of the files in the batch not yet saved by save_batch_db
+
+    Notes
+    -----
+    The file is a duplicate if the file already at its DBB path is in the
+    pending batch or in the DB.  Otherwise the file on disk is not in the
+    DBB, which is reported as a consistency error.
+    """
+    src_info = entry["src_info"]
+    # the pending batch is checked first, its files are not in the DB yet
+    duplicate = src_info["filename"] in pending_filenames
+    if not duplicate:
+        duplicate = db_funcs.filename_exists_in_dbb(dbh, src_info["filename"])
+    if duplicate:
+        _log.debug("Non-unique filename = %s", src_info["filename"])
+        msg = DUPLICATE_MSG
+    else:
+        _log.error("%s: %s", src_info["tar_filename"], entry["exists_msg"])
+        msg = entry["exists_msg"]
+    handle_bad_file(config, dbh, src_info["tar_filename"], src_info, msg)
+    db_funcs.commit_batch(dbh)
+
+
+def get_registration_process(dbh, src_info):
+    """Find the registration process of the file's uuid, creating it if needed
+
+    Parameters
+    ----------
+    dbh : `cx_Oracle.Connection`
+        Open database connection with write access to DBB tables
+    src_info : `dict`
+        Dictionary containing information about the file
+
+    Returns
+    -------
+    process_id : `int`
+        Process id to be used for provenance
+
+    Notes
+    -----
+    Tarballs from the same staging run share a uuid and may be handled by
+    different worker processes at the same time, so the lookup and the
+    insert are done holding a lock shared by all the workers.  If another
+    ingest program registered the uuid meanwhile (UNIQUE violation on
+    file_registration_lookup.uuid), its process is used.
+    """
+    with _registration_lock:
+        process_id = db_funcs.get_registration_process_id(dbh, src_info["uuid"])
+        if process_id is None:
+            try:
+                process_id = db_funcs.save_registration_info(dbh, src_info)
+                # commit now so other tarballs with the same uuid find this process
+                db_funcs.commit_batch(dbh)
+            except Exception as err:
+                if not db_funcs.is_unique_violation(err):
+                    raise
+                dbh.rollback()
+                process_id = db_funcs.get_registration_process_id(dbh, src_info["uuid"])
+                if process_id is None:
+                    raise
+    return process_id
 
 
 def move_bad_file(config, tar_filename):
@@ -475,7 +795,7 @@ def move_bad_file(config, tar_filename):
     destbad = "%s/%s" % (newpath, os.path.basename(tar_filename))
 
     if os.path.exists(destbad):
-        logging.warning("bad file already exists (%s)", destbad)
+        _log.warning("bad file already exists (%s)", destbad)
         os.remove(destbad)
 
     # make directory in "bad file" area and move file there
@@ -484,7 +804,7 @@ def move_bad_file(config, tar_filename):
     return relpath
 
 
-def handle_bad_file(config, dbh, src_info, msg):
+def handle_bad_file(config, dbh, tar_filename, src_info, msg):
     """ Perform steps required by any bad file
 
     Parameters
@@ -493,29 +813,38 @@ def handle_bad_file(config, dbh, src_info, msg):
         Dictionary containing program configuration options
     dbh : `cx_Oracle.Connection`
         Open database connection with write access to DBB tables
-    src_info : `dict`
-        Dictionary containing information about file
+    tar_filename : `str`
+        filename of tarball including delivery path
+    src_info : `dict` or None
+        Dictionary containing information about file, None if the
+        tarball was rejected before its info file was read
     msg: `str`
         String explaining cause of rejection
-    """
-    dbh.rollback()  # undo any db changes for this file
 
-    logging.info("msg = %s", msg)
-    logging.debug("src_info = %s", src_info)
-    logging.debug("dataset_type = %s", src_info["dataset_type"])
+    Notes
+    -----
+    The bad file row is not committed, so callers can commit the rows for
+    many bad files at once.  Callers must roll back any other pending
+    changes for the file first.
+    """
+    _log.info("msg = %s", msg)
+    if _log.isEnabledFor(logging.DEBUG):
+        _log.debug("src_info = %s", src_info)
+        if src_info is not None:
+            _log.debug("dataset_type = %s", src_info["dataset_type"])
 
     bad_info = {}
     if src_info is not None:
         bad_info["delivery_date"] = datetime.fromtimestamp(src_info["timestamp"])
     else:
-        bad_info["delivery_date"] = datetime.fromtimestamp(os.path.getmtime(src_info["tar_filename"]))
-    logging.debug("delivery_date = %s", bad_info["delivery_date"])
-    bad_info["uniq_filename"] = os.path.basename(src_info["tar_filename"])
-    bad_info["disk_usage"] = os.path.getsize(src_info["tar_filename"])
+        bad_info["delivery_date"] = datetime.fromtimestamp(os.path.getmtime(tar_filename))
+    _log.debug("delivery_date = %s", bad_info["delivery_date"])
+    bad_info["uniq_filename"] = os.path.basename(tar_filename)
+    bad_info["disk_usage"] = os.path.getsize(tar_filename)
     bad_info["rejected_date"] = datetime.now()
     bad_info["rejected_msg"] = msg
 
-    badpath = move_bad_file(config, src_info["tar_filename"])
+    badpath = move_bad_file(config, tar_filename)
     bad_info["relpath"] = badpath
 
     db_funcs.save_bad_file_db(dbh, bad_info, src_info)
@@ -542,12 +871,11 @@ def get_list_tarballs(delivery_dir):
     if not os.path.exists(delivery_dir):
         raise FileNotFoundError("Delivery directory does not exist: %s" % delivery_dir)
     # order the returned list so ingested in order of delivery
-    filenames = next(os.walk(delivery_dir))[2]
-    tarballs = []
-    for fname in filenames:
-        if fname.endswith(".tar"):
-            tarballs.append("%s/%s" % (delivery_dir, fname))
-    return sorted(tarballs, key=os.path.getmtime)
+    with os.scandir(delivery_dir) as entries:
+        tarballs = [(entry.stat().st_mtime_ns, entry.path) for entry in entries
+                    if entry.name.endswith(".tar") and entry.is_file()]
+    tarballs.sort()
+    return [path for _, path in tarballs]
 
 
 def read_digest(infh, delim="\t"):
@@ -556,7 +884,8 @@ def read_digest(infh, delim="\t"):
     Parameters
     ----------
     infh : ``
-        Object with readlines capability that contains digest information
+        Object with readlines capability, or `str`/`bytes` contents of
+        the digest file, that contains digest information
         Digest line format similar to md5sum digest:
             chksum<delim>filename
         where filename does not include path
@@ -568,70 +897,79 @@ def read_digest(infh, delim="\t"):
     digest : `dict`
         Filename to expected chksum value mapping
     """
+    if isinstance(infh, bytes):
+        infh = infh.decode()
+    lines = infh.splitlines() if isinstance(infh, str) else infh.readlines()
+
     digest = {}
-    for line in infh.readlines():
+    for line in lines:
         line = line.strip()
         vals = [x.strip() for x in line.split(delim)]
         digest[vals[1]] = vals[0]
     return digest
 
 
-def untar2dir(tarfilename, outputdir):
-    """Untars tarball to a specific directory.
+def read_tarball(tarfilename, outputdir):
+    """Read the info and digest files from a tarball and extract the raw file
 
     Parameters
     ----------
     tarfilename : `str`
         Name of tarball including path
     outputdir : `str`
-        Path into which the contents of the tarball should be extracted
-    """
-    if tarfilename.endswith(".gz"):
-        mode = "r:gz"
-    else:
-        mode = "r"
-
-    with tarfile.open(tarfilename, mode) as tar:
-        tar.extractall(outputdir)
-
-
-def get_filenames():
-    """ Get filenames that were just extracted from tarball
+        Path into which the raw file should be extracted
 
     Returns
     -------
     filename : `str`
-        filename of the raw file to be stored in the DBB
+        filename (no path) of the raw file to be stored in the DBB
+    data_fname : `str`
+        filename of the extracted raw file including outputdir
     info_fname : `str`
         filename of the yaml file containing information about
         raw file including provenance
-    digest_fname : `str`
-        filename of the text file containing chksum information
+    info_data : `bytes`
+        contents of the info file
+    digest_data : `bytes`
+        contents of the text file containing chksum information
         about the raw and info files
 
     Notes
     -----
-    Assumes already in directory where the only files are those
-    extracted from the tarball with no subdirectory structure
+    Only the raw file is written to disk (it is needed there to be moved
+    into the DBB).  Assumes no subdirectory structure inside the tarball.
     """
+    if tarfilename.endswith(".gz"):
+        mode = "r:gz"
+    else:
+        mode = "r"
+
     filename = None
     info_fname = None
-    digest_fname = None
-
-    files = glob.glob("*")
-    for fname in files:
-        if fname.endswith(".info"):
-            info_fname = fname
-        elif fname.endswith(".digest"):
-            digest_fname = fname
-        else:
-            filename = fname
+    info_data = None
+    digest_data = None
 
-    logging.debug(filename)
-    return filename, info_fname, digest_fname
+    with tarfile.open(tarfilename, mode) as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            if member.name.endswith(".info"):
+                info_fname = member.name
+                info_data = tar.extractfile(member).read()
+            elif member.name.endswith(".digest"):
+                digest_data = tar.extractfile(member).read()
+            else:
+                # the extracted file is what is moved into the DBB, so it
+                # keeps the mode and mtime it was archived with
+                filename = member.name
+                tar.extract(member, outputdir)
 
+    _log.debug(filename)
+    return filename, os.path.join(outputdir, filename), info_fname, info_data, digest_data
 
-def integrity_check(filename, expected, chksum_type="md5", blksize=chksum_utils.DEFAULT_BLKSIZE):
+
+def integrity_check(filename, expected, chksum_type="md5", blksize=chksum_funcs.DEFAULT_BLKSIZE,
+                    data=None):
     """ Compare chksums between expected and computed actual
 
     Parameters
@@ -644,18 +982,219 @@ def integrity_check(filename, expected, chksum_type="md5", blksize=chksum_utils.
         Name of method to use for calculating the chksum
     blksize : `int`
         Number of bytes to read in a single chunk from the file
+    data : buffer, optional
+        Contents of the file already in memory (e.g., `mmap.mmap`).  If
+        given, the chksum is calculated from it instead of rereading the file
 
     Raises
     ------
     ValueError if expected and actual chksums do not match
     """
-    logging.info("Integrity checking file: %s", filename)
-    actual = chksum_utils.calc_chksum(name=filename, chksum_type=chksum_type, blksize=blksize)
-    logging.debug("Expected chksum = %s    Actual chksum = %s", expected, actual)
+    _log.info("Integrity checking file: %s", filename)
+    actual = chksum_funcs.calc_chksum(name=filename, chksum_type=chksum_type, blksize=blksize, data=data)
+    _log.debug("Expected chksum = %s    Actual chksum = %s", expected, actual)
     if expected != actual:
         raise ValueError("%s chksums (%s) do not match" % (filename, chksum_type))
 
-    logging.info("%s passed integrity check", filename)
+    _log.info("%s passed integrity check", filename)
+
+
+def init_worker(db_config, registration_lock, log_level):
+    """Open the DB connection used by a worker process for all its tarballs
+
+    Parameters
+    ----------
+    db_config : `dict`
+        dictionary containing values needed to connect to DB
+    registration_lock : `multiprocessing.Lock`
+        Lock shared by all the workers (see get_registration_process)
+    log_level : `int`
+        Logging level of the parent process (a spawned worker does not
+        inherit the logging configuration)
+    """
+    global _worker_dbh, _registration_lock
+    logging.basicConfig(format=LOG_FORMAT, datefmt=LOG_DATEFMT, level=log_level)
+    _registration_lock = registration_lock
+    _worker_dbh = db_funcs.open_db_connection(db_config)
+    # pool workers exit without running atexit, but do run multiprocessing finalizers
+    multiprocessing.util.Finalize(None, _worker_dbh.close, exitpriority=10)
+    db_funcs.prepare_statements(_worker_dbh)
+
+
+def _cleanup_worker():
+    """Remove scratch directories from the cleanup queue until the program exits
+    """
+    while True:
+        scratch_dir = _cleanup_queue.get()
+        try:
+            shutil.rmtree(scratch_dir)
+        except OSError as err:
+            _log.warning("Could not remove scratch directory %s: %s", scratch_dir, err)
+        finally:
+            _cleanup_queue.task_done()
+
+
+def start_cleanup_thread():
+    """Start the background thread that removes scratch directories
+
+    Notes
+    -----
+    Removing a directory tree is one metadata operation per file, which
+    is slow on network filesystems, so it is kept out of the ingest loop.
+    Directories still queued are removed before the program exits.
+    """
+    threading.Thread(target=_cleanup_worker, name="scratch-cleanup", daemon=True).start()
+    atexit.register(_cleanup_queue.join)
+
+
+def get_scratch_dir(tar_filename, scratch_base):
+    """Get the name of the scratch subdirectory for a tarball
+
+    Parameters
+    ----------
+    tar_filename : `str`
+        The tarball filname including the path to the delivery area.
+    scratch_base : `str`
+        Scratch directory for this run
+
+    Returns
+    -------
+    scratch_dir : `str`
+        Scratch subdirectory for the tarball
+    """
+    dirprefix = os.path.splitext(os.path.basename(tar_filename))[0]
+    return os.path.join(scratch_base, dirprefix)
+
+
+def ingest_tarball(tar_filename, config, scratch_base, dbh=None):
+    """Ingest a single tarball using its own scratch subdirectory
+
+    Parameters
+    ----------
+    tar_filename : `str`
+        The tarball filname including the path to the delivery area.
+    config : `dict`
+        Dictionary containing program configuration options
+    scratch_base : `str`
+        Scratch directory for this run in which the tarball's scratch
+        subdirectory is made (removing it is left to the caller)
+    dbh : `cx_Oracle.Connection`, optional
+        Open database connection with write access to DBB tables.
+        Defaults to the connection opened by init_worker.
+
+    Returns
+    -------
+    entry : `dict` or None
+        Information needed by save_batch_db, see handle_tarball
+    """
+    if dbh is None:
+        dbh = _worker_dbh
+
+    scratch_dir = get_scratch_dir(tar_filename, scratch_base)
+    os.makedirs(scratch_dir)
+    _log.debug("Scratch directory = %s", scratch_dir)
+
+    return handle_tarball(tar_filename, scratch_dir, dbh, config)
+
+
+def ingest_tarballs(tarballs, config, scratch_base, keep, jobs, dbh):
+    """Ingest tarballs, in parallel worker processes if jobs > 1
+
+    Parameters
+    ----------
+    tarballs : `list` [`str`]
+        The tarball filenames including the path to the delivery area.
+    config : `dict`
+        Dictionary containing program configuration options
+    scratch_base : `str`
+        Scratch directory for this run in which each tarball's scratch
+        subdirectory is made
+    keep : `bool`
+        If True, scratch directories are not deleted, otherwise each is
+        queued for the cleanup thread as soon as its tarball is finished
+    jobs : `int`
+        Number of tarballs to ingest in parallel
+    dbh : `cx_Oracle.Connection`
+        Open database connection used when not ingesting in parallel
+
+    Yields
+    ------
+    entry : `dict` or None
+        Information needed by save_batch_db for each tarball as it finishes
+
+    Notes
+    -----
+    If the generator is closed (or raises) before every tarball is
+    yielded, tarballs not yet started are cancelled and the files of
+    those finished but not yielded are removed from the DBB (see undo_batch).
+    """
+    if jobs > 1:
+        # each worker process has its own DB connection
+        mp_context = multiprocessing.get_context(WORKER_START_METHOD)
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=mp_context, initializer=init_worker,
+                                 initargs=(config["db"], mp_context.Lock(),
+                                           logging.getLogger().getEffectiveLevel())) as executor:
+            futures = {executor.submit(ingest_tarball, tar_filename, config, scratch_base): tar_filename
+                       for tar_filename in tarballs}
+            not_yielded = set(futures)
+            try:
+                for future in as_completed(futures):
+                    not_yielded.discard(future)
+                    if not keep:
+                        _cleanup_queue.put(get_scratch_dir(futures[future], scratch_base))
+                    yield future.result()
+            finally:
+                if not_yielded:
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    finished = [future for future in not_yielded
+                                if not future.cancelled() and future.exception() is None]
+                    undo_batch([future.result() for future in finished if future.result() is not None])
+    else:
+        for tar_filename in tarballs:
+            try:
+                entry = ingest_tarball(tar_filename, config, scratch_base, dbh)
+            finally:
+                if not keep:
+                    _cleanup_queue.put(get_scratch_dir(tar_filename, scratch_base))
+            yield entry
+
+
+def save_entries(dbh, config, entries, commit_every):
+    """Save the DB entries of ingested files in batches
+
+    Parameters
+    ----------
+    dbh : `cx_Oracle.Connection`
+        Open database connection with write access to DBB tables
+    config : `dict`
+        Dictionary containing program configuration options
+    entries : iterable [`dict` or None]
+        Entries returned by handle_tarball (e.g., from ingest_tarballs)
+    commit_every : `int`
+        Number of files saved and committed together
+
+    Notes
+    -----
+    If this stops before a batch is saved, the batch's files are removed
+    from the DBB (see undo_batch), so the next run ingests them again.
+    """
+    batch = []
+    try:
+        for entry in entries:
+            if entry is None:
+                continue
+            if entry["fullname"] is None:
+                handle_existing_file(config, dbh, entry,
+                                     {pending["src_info"]["filename"] for pending in batch})
+                continue
+            batch.append(entry)
+            if len(batch) >= commit_every:
+                save_batch_db(dbh, config, batch)
+                batch = []
+        save_batch_db(dbh, config, batch)
+        batch = []
+    finally:
+        undo_batch(batch)
 
 
 def main(argv):
@@ -666,38 +1205,39 @@ def main(argv):
     argv : `list`
         list of command-line arguments to pass to argparse
     """
-    cwd = os.getcwd()
     args = parse_args(argv)
 
     # set logging configuration
-    logging.basicConfig(format="%(levelname)s::%(asctime)s::%(message)s", datefmt="%m/%d/%Y %H:%M:%S")
+    logging.basicConfig(format=LOG_FORMAT, datefmt=LOG_DATEFMT)
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
     elif args.verbose:
         logging.getLogger().setLevel(logging.INFO)
 
-    logging.debug("Cmdline args = %s", args)
+    _log.debug("Cmdline args = %s", args)
     config = read_config(args.config)
     tarballs = get_list_tarballs(config["delivery_dir"])
-    logging.debug("tarballs = %s", tarballs)
+    if _log.isEnabledFor(logging.DEBUG):
+        _log.debug("tarballs = %s", tarballs)
 
     if tarballs:
-        dbh = db_funcs.open_db_connection(config["db"])
-        print(type(dbh))
-        for tar_filename in tarballs:
-            dirprefix = os.path.splitext(os.path.basename(tar_filename))[0]
-            scratch_dir = tempfile.mkdtemp(prefix=dirprefix, dir=config["scratch_root"])
-            logging.debug("Scratch directory = %s", scratch_dir)
-
-            try:
-                handle_tarball(tar_filename, scratch_dir, dbh, config)
-            finally:
-                os.chdir(cwd)
-                if not args.keep and dirprefix in scratch_dir:
-                    shutil.rmtree(scratch_dir)
-        dbh.close()
+        # one scratch directory per run, each tarball gets a subdirectory
+        scratch_base = tempfile.mkdtemp(prefix="dbb_ingest_", dir=config["scratch_root"])
+        if not args.keep:
+            atexit.register(shutil.rmtree, scratch_base, ignore_errors=True)
+            # registered after the rmtree above so atexit drains the queue first
+            start_cleanup_thread()
+
+        with db_funcs.open_db_connection(config["db"]) as dbh:
+            db_funcs.prepare_statements(dbh)
+
+            # files are moved into the DBB as each tarball is handled, but
+            # their DB entries are saved and committed in batches
+            with contextlib.closing(ingest_tarballs(tarballs, config, scratch_base, args.keep,
+                                                    args.jobs, dbh)) as entries:
+                save_entries(dbh, config, entries, config.get("commit_every", DEFAULT_COMMIT_EVERY))
     else:
-        logging.info("0 tarballs in delivery directory")
+        _log.info("0 tarballs in delivery directory")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,374 @@
+# This file is part of dbb_gateway.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Helper functions for calculating chksums of files being ingested
+   into the Data Backbone
+"""
+import contextlib
+import hashlib
+import mmap
+import os
+import shutil
+import stat
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import google_crc32c
+except ImportError:
+    google_crc32c = None
+
+DEFAULT_BLKSIZE = 4 * 1024 * 1024
+
+# Tree chksums hash fixed-size segments independently and then hash the
+# concatenated segment digests.  The segment size is part of the chksum
+# definition (not a tuning knob) so values do not depend on worker count.
+TREE_SUFFIX = "_tree"
+TREE_SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+class _TreeHasher:
+    """Incrementally calculate a tree chksum (see calc_chksum_parallel)
+
+    Parameters
+    ----------
+    hash_name : `str`
+        Name of the chksum method applied to segments and to the
+        concatenated segment digests
+    """
+    def __init__(self, hash_name):
+        self._hash_name = hash_name
+        self._digests = []
+        self._segment = new_hasher(hash_name)
+        self._segment_left = TREE_SEGMENT_SIZE
+
+    def update(self, data):
+        view = memoryview(data).cast("B")
+        while view:
+            chunk = view[:self._segment_left]
+            self._segment.update(chunk)
+            self._segment_left -= len(chunk)
+            view = view[len(chunk):]
+            if self._segment_left == 0:
+                self._digests.append(self._segment.digest())
+                self._segment = new_hasher(self._hash_name)
+                self._segment_left = TREE_SEGMENT_SIZE
+
+    def digest(self):
+        digests = list(self._digests)
+        if self._segment_left < TREE_SEGMENT_SIZE:
+            digests.append(self._segment.digest())
+        hasher = new_hasher(self._hash_name)
+        hasher.update(b"".join(digests))
+        return hasher.digest()
+
+
+def new_hasher(chksum_type):
+    """Create a hash object for the given chksum type
+
+    Parameters
+    ----------
+    chksum_type : `str`
+        Name of method to use for calculating the chksum.  "crc32c" uses
+        the hardware-accelerated google-crc32c package; a method + "_tree"
+        incrementally calculates a tree chksum; anything else (md5, sha256,
+        ...) is passed to hashlib, which uses OpenSSL (and SHA extensions
+        where the CPU has them).
+
+    Returns
+    -------
+    hasher : `object`
+        Object with hashlib-style update and digest methods
+
+    Raises
+    ------
+    ValueError
+        Raised if chksum_type is crc32c but google-crc32c is not installed
+    """
+    if is_tree_type(chksum_type):
+        return _TreeHasher(chksum_type[:-len(TREE_SUFFIX)])
+    if chksum_type == "crc32c":
+        if google_crc32c is None:
+            raise ValueError("chksum_type crc32c requires the google-crc32c package")
+        return google_crc32c.Checksum()
+    return hashlib.new(chksum_type)
+
+
+def is_tree_type(chksum_type):
+    """Check whether the chksum type is a parallel tree chksum
+
+    Parameters
+    ----------
+    chksum_type : `str`
+        Name of method used for calculating the chksum
+
+    Returns
+    -------
+    is_tree : `bool`
+        True if chksum_type names a tree chksum (e.g., md5_tree)
+    """
+    return chksum_type.endswith(TREE_SUFFIX)
+
+
+def _tree_digest(buf, hash_name, nworkers):
+    """Calculate a tree chksum of a buffer hashing segments in threads
+
+    Parameters
+    ----------
+    buf : buffer
+        Data to chksum (e.g., `bytes` or `mmap.mmap`)
+    hash_name : `str`
+        Name of the chksum method applied to segments and to the
+        concatenated segment digests
+    nworkers : `int`
+        Number of threads used to hash the segments
+
+    Returns
+    -------
+    chksum : `str`
+        Hex string of the tree chksum
+    """
+    with memoryview(buf) as view:
+        offsets = range(0, len(view), TREE_SEGMENT_SIZE)
+
+        def segment_digest(offset):
+            # hashers release the GIL while hashing large buffers
+            hasher = new_hasher(hash_name)
+            hasher.update(view[offset:offset + TREE_SEGMENT_SIZE])
+            return hasher.digest()
+
+        with ThreadPoolExecutor(max_workers=nworkers) as executor:
+            digests = list(executor.map(segment_digest, offsets))
+    hasher = new_hasher(hash_name)
+    hasher.update(b"".join(digests))
+    return hasher.digest().hex()
+
+
+def calc_chksum_parallel(name, chksum_type="md5_tree", nworkers=None):
+    """Calculate a tree chksum of a file using multiple threads
+
+    Parameters
+    ----------
+    name : `str`
+        Name of file on which to calculate chksum, includes path if needed
+    chksum_type : `str`
+        Name of the tree chksum method (base method + "_tree")
+    nworkers : `int`, optional
+        Number of threads used to hash segments.  Defaults to the number of CPUs.
+
+    Returns
+    -------
+    chksum : `str`
+        Hex string of the tree chksum
+
+    Notes
+    -----
+    A tree chksum is not the same value as the plain chksum of the file,
+    so it can only be compared to other tree chksums.
+    """
+    hash_name = chksum_type[:-len(TREE_SUFFIX)] if is_tree_type(chksum_type) else chksum_type
+    if nworkers is None:
+        nworkers = os.cpu_count() or 1
+
+    with open(name, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:   # cannot mmap empty file
+            return _tree_digest(b"", hash_name, 1)
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return _tree_digest(data, hash_name, nworkers)
+
+
+def calc_chksum(name=None, chksum_type="md5", blksize=DEFAULT_BLKSIZE, data=None):
+    """Calculate the chksum of a file or of its contents already in memory
+
+    Parameters
+    ----------
+    name : `str`, optional
+        Name of file on which to calculate chksum, includes path if needed.
+        Required if data is not given.
+    chksum_type : `str`
+        Name of method to use for calculating the chksum (see new_hasher),
+        or a method + "_tree" for a parallel tree chksum.
+    blksize : `int`
+        Number of bytes to read in a single chunk from the file
+    data : buffer, optional
+        Contents of the file (e.g., `mmap.mmap`).  If given, the file is not read.
+
+    Returns
+    -------
+    chksum : `str`
+        Hex string of the chksum
+    """
+    if is_tree_type(chksum_type):
+        if data is None:
+            return calc_chksum_parallel(name, chksum_type)
+        return _tree_digest(data, chksum_type[:-len(TREE_SUFFIX)], os.cpu_count() or 1)
+
+    hasher = new_hasher(chksum_type)
+    if data is not None:
+        hasher.update(data)
+    else:
+        with open(name, "rb") as fh:
+            for buf in iter(lambda: fh.read(blksize), b""):
+                hasher.update(buf)
+    return hasher.digest().hex()
+
+
+@contextlib.contextmanager
+def _streamed_once(*fileobjs):
+    """Tell the kernel the files are read/written sequentially once
+
+    Parameters
+    ----------
+    *fileobjs : file objects
+        Open files to advise about
+
+    Notes
+    -----
+    Asks for aggressive readahead while in the context and drops the
+    files' pages from the page cache on exit, so large raw files do not
+    evict more useful pages.  Does nothing where posix_fadvise is not
+    available (e.g., macOS).
+    """
+    if not hasattr(os, "posix_fadvise"):
+        yield
+        return
+
+    for fileobj in fileobjs:
+        os.posix_fadvise(fileobj.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    try:
+        yield
+    finally:
+        for fileobj in fileobjs:
+            fileobj.flush()
+            os.posix_fadvise(fileobj.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def _copy_file(srcfh, dstfh, size):
+    """Copy file contents without passing them through user space
+
+    Parameters
+    ----------
+    srcfh : file object
+        File to copy, opened for binary reading
+    dstfh : file object
+        New empty file, opened for binary writing
+    size : `int`
+        Number of bytes in src
+
+    Notes
+    -----
+    Uses copy_file_range if the kernel and filesystems support it, else
+    sendfile, and only copies through user space if neither works.
+    """
+    for name in ("copy_file_range", "sendfile"):
+        if _copy_in_kernel(getattr(os, name, None), srcfh, dstfh, size):
+            return
+    shutil.copyfileobj(srcfh, dstfh, DEFAULT_BLKSIZE)
+
+
+def _copy_in_kernel(copy_func, srcfh, dstfh, size):
+    """Copy file contents with os.copy_file_range or os.sendfile
+
+    Parameters
+    ----------
+    copy_func : callable or None
+        os.copy_file_range or os.sendfile (None if not on this platform)
+    srcfh : file object
+        File to copy, opened for binary reading
+    dstfh : file object
+        New empty file, opened for binary writing
+    size : `int`
+        Number of bytes in src
+
+    Returns
+    -------
+    copied : `bool`
+        True if the file was copied, False if copy_func is not supported
+        (nothing has been written to dstfh)
+    """
+    if copy_func is None:
+        return False
+
+    offset = 0
+    try:
+        while offset < size:
+            if copy_func is os.sendfile:
+                copied = os.sendfile(dstfh.fileno(), srcfh.fileno(), offset, size - offset)
+            else:
+                copied = copy_func(srcfh.fileno(), dstfh.fileno(), size - offset)
+            if copied == 0:
+                break
+            offset += copied
+    except OSError:
+        # e.g., kernel or filesystem without support for this copy
+        if offset:
+            raise
+        return False
+    return True
+
+
+def copy_and_hash(src, dst, chksum_type=None, bufsize=DEFAULT_BLKSIZE):
+    """Copy a file calculating its chksum from the same single read
+
+    Parameters
+    ----------
+    src : `str`
+        Name of the file to copy, including any necessary path
+    dst : `str`
+        Name of the new file, including any necessary path
+    chksum_type : `str`, optional
+        Name of method to use for calculating the chksum (see new_hasher).
+        If None, no chksum is calculated and the copy is done in the kernel.
+    bufsize : `int`
+        Number of bytes to read in a single chunk from the file
+
+    Returns
+    -------
+    chksum : `str` or None
+        Hex string of the chksum of the bytes copied, None if chksum_type is None
+
+    Raises
+    ------
+    FileExistsError
+        Raised if dst already exists (dst is created with O_EXCL, so the
+        check and the create are a single atomic open)
+
+    Notes
+    -----
+    Like shutil.copy2, the permission bits and access/modification times
+    of src are copied to dst.  The chksum is calculated from the bytes
+    read from src as they are written, not by rereading dst.
+    """
+    chksum = None
+    with open(src, "rb") as srcfh, open(dst, "xb") as dstfh, _streamed_once(srcfh, dstfh):
+        src_stat = os.fstat(srcfh.fileno())
+        if chksum_type is None:
+            _copy_file(srcfh, dstfh, src_stat.st_size)
+        else:
+            hasher = new_hasher(chksum_type)
+            buf = bytearray(bufsize)
+            with memoryview(buf) as view:
+                for nbytes in iter(lambda: srcfh.readinto(buf), 0):
+                    hasher.update(view[:nbytes])
+                    dstfh.write(view[:nbytes])
+            chksum = hasher.digest().hex()
+
+    os.chmod(dst, stat.S_IMODE(src_stat.st_mode))
+    os.utime(dst, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+    return chksum
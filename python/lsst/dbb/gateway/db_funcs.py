@@ -23,6 +23,9 @@
    Oracle database
 """
 import logging
+import os
+from collections import namedtuple
+from contextvars import ContextVar
 from datetime import datetime
 import cx_Oracle
 
@@ -30,9 +33,418 @@ import cx_Oracle
 # - Place-holder until Gen3 Butler code is ready
 # - only works with Oracle
 
+SQL_INSERT_DATASTORE = ("insert into datastore_dbb (dataset_id, filename, relpath, filesize, chksum, "
+                        "chksum_type) values (:dataset_id, :filename, :relpath, :filesize, :chksum, "
+                        ":chksum_type)")
+SQL_SELECT_FILENAME = "select filename from datastore_dbb where filename=:filename"
+SQL_INSERT_DATASET_RETURNING = ("insert into dataset (id, wgb_process_id, dataset_type) "
+                                "values (DATASET_SEQ.nextval, :process_id, :dataset_type) "
+                                "returning id into :new_id")
+SQL_UPDATE_END_TIME = "update process set end_time=SYSTIMESTAMP where id=:id"
+SQL_SELECT_REGISTRATION_PROCESS = ("select file_registration_process_id from file_registration_lookup "
+                                   "where uuid=:uuid")
+# converts a bound epoch (seconds since 1970-01-01 UTC) to a timestamp in the
+# database server's time zone, the same zone as the SYSTIMESTAMP end times
+SQL_EPOCH_TO_TIMESTAMP = ("cast(from_tz(timestamp '1970-01-01 00:00:00' + "
+                          "numtodsinterval(:start_time, 'SECOND'), 'UTC') "
+                          "at time zone to_char(SYSTIMESTAMP, 'TZH:TZM') as timestamp)")
+# nextval and currval in the same statement give the same value
+SQL_INSERT_PROCESS = ("insert into process (ID, NAME, INFO_TABLE, EXEC_HOST, START_TIME, ROOT_PROCESS_ID) "
+                      "values (PROCESS_SEQ.nextval, :name, :info_table, :exec_host, %s, "
+                      "PROCESS_SEQ.currval) returning id into :new_id" % SQL_EPOCH_TO_TIMESTAMP)
+SQL_INSERT_FILE_REGISTRATION = ("insert into file_registration (PROCESS_ID, USERNAME, PROV_MSG) values "
+                                "(:process_id, :username, :provmsg)")
+SQL_INSERT_REGISTRATION_LOOKUP = ("insert into file_registration_lookup (UUID, FILE_REGISTRATION_PROCESS_ID) "
+                                  "values (:uuid, :process_id)")
+# registers a file registration process in a single round-trip
+PLSQL_SAVE_REGISTRATION = """
+begin
+    insert into process (ID, NAME, INFO_TABLE, EXEC_HOST, START_TIME, ROOT_PROCESS_ID)
+        values (PROCESS_SEQ.nextval, :name, 'file_registration', :exec_host, %s,
+                PROCESS_SEQ.currval)
+        returning ID into :process_id;
+    insert into file_registration (PROCESS_ID, USERNAME, PROV_MSG)
+        values (:process_id, :username, :provmsg);
+    insert into file_registration_lookup (UUID, FILE_REGISTRATION_PROCESS_ID)
+        values (:uuid, :process_id);
+end;""" % SQL_EPOCH_TO_TIMESTAMP
+# saves the dataset and datastore rows of a whole batch of files in a single
+# round-trip.  datastore rows that are not inserted (code 1 for a filename
+# already in datastore_dbb, or the error of any other failed row) are returned
+# in the error arrays, in which case end times are not updated and the caller
+# should roll back.  The str arrays are copied into varchar2a (varchar2(32767))
+# locals so a value too long for its column fails its datastore row (caught by
+# save exceptions), not the assignment of the whole array.
+PLSQL_SAVE_BATCH = """
+declare
+    l_process_ids dbms_sql.number_table := :process_ids;
+    l_dataset_types dbms_sql.varchar2a := :dataset_types;
+    l_filenames dbms_sql.varchar2a := :filenames;
+    l_relpaths dbms_sql.varchar2a := :relpaths;
+    l_filesizes dbms_sql.number_table := :filesizes;
+    l_chksums dbms_sql.varchar2a := :chksums;
+    l_chksum_types dbms_sql.varchar2a := :chksum_types;
+    l_end_process_ids dbms_sql.number_table := :end_process_ids;
+    l_dataset_ids dbms_sql.number_table;
+    l_error_offsets dbms_sql.number_table;
+    l_error_codes dbms_sql.number_table;
+    l_error_msgs dbms_sql.varchar2_table;
+    l_failed dbms_sql.number_table;
+    n pls_integer;
+    bulk_errors exception;
+    pragma exception_init(bulk_errors, -24381);
+begin
+    select DATASET_SEQ.nextval bulk collect into l_dataset_ids
+        from DUAL connect by level <= l_filenames.count;
+
+    forall i in 1 .. l_filenames.count
+        insert into dataset (id, wgb_process_id, dataset_type)
+            values (l_dataset_ids(i), l_process_ids(i), l_dataset_types(i));
+
+    begin
+        forall i in 1 .. l_filenames.count save exceptions
+            merge into datastore_dbb d
+                using (select l_filenames(i) as filename from DUAL) src
+                on (d.filename = src.filename)
+                when not matched then
+                    insert (dataset_id, filename, relpath, filesize, chksum, chksum_type)
+                    values (l_dataset_ids(i), l_filenames(i), l_relpaths(i), l_filesizes(i),
+                            l_chksums(i), l_chksum_types(i));
+    exception
+        when bulk_errors then
+            for j in 1 .. sql%bulk_exceptions.count loop
+                l_error_offsets(j) := sql%bulk_exceptions(j).error_index - 1;
+                l_error_codes(j) := sql%bulk_exceptions(j).error_code;
+                l_error_msgs(j) := substr(sqlerrm(-sql%bulk_exceptions(j).error_code), 1, 512);
+                l_failed(sql%bulk_exceptions(j).error_index) := 1;
+            end loop;
+    end;
+
+    -- rows the merge skipped because the filename is already in datastore_dbb
+    for i in 1 .. l_filenames.count loop
+        if sql%bulk_rowcount(i) = 0 and not l_failed.exists(i) then
+            n := l_error_offsets.count + 1;
+            l_error_offsets(n) := i - 1;
+            l_error_codes(n) := 1;
+            l_error_msgs(n) := 'filename already in datastore_dbb';
+        end if;
+    end loop;
+
+    if l_error_offsets.count = 0 then
+        forall i in 1 .. l_end_process_ids.count
+            update process set end_time=SYSTIMESTAMP where id=l_end_process_ids(i);
+    end if;
+
+    :error_offsets := l_error_offsets;
+    :error_codes := l_error_codes;
+    :error_msgs := l_error_msgs;
+end;"""
+BATCH_ERROR_MSG_LEN = 512
+
+# a row that could not be saved by save_batch (offset into the rows)
+RowError = namedtuple("RowError", ["offset", "code", "message"])
+
+# every column is always bound (None if unknown) so the SQL text never changes
+BAD_FILE_SRC_COLS = ["filename", "dataset_type", "filesize", "chksum", "chksum_type"]
+BAD_FILE_INFO_COLS = ["uniq_filename", "relpath", "disk_usage", "rejected_msg", "rejected_date"]
+BAD_FILE_COLS = BAD_FILE_SRC_COLS + ["file_registration_process_id"] + BAD_FILE_INFO_COLS
+SQL_INSERT_BAD_FILE = ("insert into dbb_bad_file (%s) values (:%s)" %
+                       (",".join(BAD_FILE_COLS), ",:".join(BAD_FILE_COLS)))
+SQL_NEXTVAL = "select %s.nextval from DUAL"
+
+# statements used for every ingested file, prepared once per connection
+INGEST_STATEMENTS = [SQL_SELECT_REGISTRATION_PROCESS, PLSQL_SAVE_REGISTRATION, PLSQL_SAVE_BATCH]
+
+# bind types so the driver does not infer them from each value (see
+# _input_sizes).  The DBB table DDL is not part of this package, so str
+# binds are not given fixed widths that could disagree with the columns:
+# each one is sized for the longest value bound and the database checks
+# the column widths (ORA-12899 for a value too long, reported per row by
+# batch errors, and for the datastore_dbb columns by the save exceptions of
+# PLSQL_SAVE_BATCH).
+DATASTORE_INPUT_TYPES = {"dataset_id": int, "filename": str, "relpath": str, "filesize": int,
+                         "chksum": str, "chksum_type": str}
+BAD_FILE_INPUT_TYPES = {"filename": str, "dataset_type": str, "filesize": int, "chksum": str,
+                        "chksum_type": str, "file_registration_process_id": int,
+                        "uniq_filename": str, "relpath": str, "disk_usage": int,
+                        "rejected_msg": str, "rejected_date": datetime}
+
+# Oracle only shares a parsed statement between executions whose str binds
+# have sizes in the same one of these ranges, so sizes are rounded up to them
+BIND_SIZE_STEPS = (32, 128, 2000, 4000)
+
+# rows bound by position (in the order of the columns in the SQL) instead of
+# by name
+DatastoreRow = namedtuple("DatastoreRow", ["dataset_id", "filename", "relpath", "filesize", "chksum",
+                                           "chksum_type"])
+BadFileRow = namedtuple("BadFileRow", BAD_FILE_COLS)
+
+# session pool sizes, overridable by pool_min/pool_max/pool_increment in db_config
+DEFAULT_POOL_MIN = 1
+DEFAULT_POOL_MAX = 4
+DEFAULT_POOL_INCREMENT = 1
+DEFAULT_POOL_WAIT_TIMEOUT_MS = 5000
+POOL_CONFIG_KEYS = {"pool_min": DEFAULT_POOL_MIN, "pool_max": DEFAULT_POOL_MAX,
+                    "pool_increment": DEFAULT_POOL_INCREMENT,
+                    "pool_wait_timeout_ms": DEFAULT_POOL_WAIT_TIMEOUT_MS}
+
+# maximum time for a single round-trip, overridable by call_timeout_ms in
+# db_config (an automated ingest should fail fast instead of hanging)
+DEFAULT_CALL_TIMEOUT_MS = 30000
+
+# a call that exceeded call_timeout but left the session usable
+# (DPI-1067, reported with ORA-03156 OCI call timed out)
+TIMEOUT_ERROR_CODES = (3156,)
+TIMEOUT_ERROR_PREFIX = "DPI-1067"
+
+# errors after which the session cannot be used any more: DPI-1080 (connection
+# closed by call timeout), ORA-03113 (end-of-file on communication channel)
+# and ORA-03114 (not connected)
+BROKEN_ERROR_CODES = (3113, 3114)
+BROKEN_ERROR_PREFIX = "DPI-1080"
+
+# statements kept parsed per session (keyed by exact SQL text, so SQL is
+# kept in the module constants above)
+STMT_CACHE_SIZE = 40
+
+_log = logging.getLogger(__name__)
+
+# session pool shared by the connections of this process (see get_session_pool)
+_pool = None
+_pool_pid = None
+
+# prepared cursors of the current thread/context, {id(dbh): (dbh, {sql: cursor})}
+# (see prepared_cursor and reset_cursor)
+_stmt_cursors = ContextVar("_stmt_cursors", default=None)
+
+
+class DbbConnection(cx_Oracle.Connection):
+    """Connection that closes its prepared cursors (see prepared_cursor)
+       and returns its session to the pool when closed
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session_pool = None   # set by open_db_connection
+
+    def close(self):
+        """Close the prepared cursors of the current thread/context, roll
+           back any uncommitted work and release the session back to the
+           pool it was acquired from (or close it if not from a pool).
+           A broken session is dropped from the pool instead.
+        """
+        broken = False
+        try:
+            reset_cursor(self)
+            self.rollback()
+        except cx_Oracle.DatabaseError as err:
+            if not is_connection_broken(err):
+                raise
+            broken = True
+        if self.session_pool is not None:
+            pool, self.session_pool = self.session_pool, None
+            if broken:
+                pool.drop(self)
+            else:
+                pool.release(self)
+        elif not broken:
+            super().close()
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+
+def _cursor(dbh, arraysize=1, prefetch=1):
+    """Create a cursor with fetch sizes for the expected number of rows
+
+    Parameters
+    ----------
+    dbh : `cx_Oracle.Connection`
+        Open database connection
+    arraysize : `int`
+        Number of rows fetched from the client buffer per internal fetch
+    prefetch : `int`
+        Number of rows the server returns with the execute
+
+    Returns
+    -------
+    curs : `cx_Oracle.Cursor`
+        New cursor
+
+    Notes
+    -----
+    The defaults suit single-row queries and DML.  For a query returning
+    at most n rows, prefetch=n+1 returns the whole result (and its end)
+    with the execute.  Queries with large result sets (e.g., future
+    reporting queries) should use a larger arraysize such as 200.
+    """
+    curs = dbh.cursor()
+    curs.arraysize = arraysize
+    curs.prefetchrows = prefetch
+    return curs
+
+
+def _bind_size(values):
+    """Size of a str bind holding values
+
+    Parameters
+    ----------
+    values : `list` [`str` or `None`]
+        Values bound (one per row)
+
+    Returns
+    -------
+    size : `int`
+        Length of the longest value rounded up to a BIND_SIZE_STEPS step
+    """
+    longest = max((len(val) for val in values if val is not None), default=1)
+    return next((step for step in BIND_SIZE_STEPS if longest <= step), longest)
+
+
+def _input_sizes(types, rows):
+    """Get the setinputsizes arguments for binding rows
+
+    Parameters
+    ----------
+    types : `dict` [`str`, `type`]
+        Bind type of each column (e.g., DATASTORE_INPUT_TYPES)
+    rows : `list` [`tuple`]
+        Namedtuple rows to bind, with fields in types
+
+    Returns
+    -------
+    sizes : `dict` [`str`, `type` or `int`]
+        Type of each field in the order of the row fields, replaced by the
+        size from _bind_size for str fields
+    """
+    return {col: _bind_size([getattr(row, col) for row in rows]) if types[col] is str else types[col]
+            for col in rows[0]._fields}
+
+
+def prepared_cursor(dbh, sql, arraysize=1, prefetch=1):
+    """Get a cursor on which the given SQL statement has been prepared
+
+    Parameters
+    ----------
+    dbh : `cx_Oracle.Connection` or `cx_Oracle.Cursor`
+        Open database connection, or a cursor to reuse
+    sql : `str`
+        SQL statement
+    arraysize : `int`
+        Fetch size used if a new cursor is created (see _cursor)
+    prefetch : `int`
+        Prefetch size used if a new cursor is created (see _cursor)
+
+    Returns
+    -------
+    curs : `cx_Oracle.Cursor`
+        Cursor with sql prepared, execute it with ``curs.execute(None, ...)``.
+        The same cursor is returned for every call with the same sql and
+        connection in the same thread/context, until reset_cursor is
+        called (by `DbbConnection.close`).  If dbh is a cursor, it is
+        returned, prepared again only if its last statement was different.
+
+    Notes
+    -----
+    Every function in this module taking dbh gets its cursors here, so
+    they all accept either a connection or a cursor.
+    """
+    if isinstance(dbh, cx_Oracle.Cursor):
+        if dbh.statement != sql:
+            dbh.prepare(sql)
+        return dbh
+
+    scoped = _stmt_cursors.get()
+    if scoped is None:
+        scoped = {}
+        _stmt_cursors.set(scoped)
+    # the connection is kept in the entry so its id cannot be reused
+    entry = scoped.get(id(dbh))
+    if entry is None:
+        entry = scoped[id(dbh)] = (dbh, {})
+    cache = entry[1]
+
+    curs = cache.get(sql)
+    if curs is None:
+        curs = _cursor(dbh, arraysize, prefetch)
+        curs.prepare(sql)
+        cache[sql] = curs
+    return curs
+
+
+def reset_cursor(dbh):
+    """Close the prepared cursors kept for dbh in the current thread/context
+       (see prepared_cursor)
+
+    Parameters
+    ----------
+    dbh : `cx_Oracle.Connection`
+        Database connection.  Must be called in every thread that used
+        dbh before dbh is discarded (`DbbConnection.close` calls it for
+        the thread closing the connection).
+    """
+    scoped = _stmt_cursors.get()
+    entry = scoped.pop(id(dbh), None) if scoped is not None else None
+    if entry is not None:
+        for curs in entry[1].values():
+            curs.close()
+
+
+def prepare_statements(dbh):
+    """Prepare the statements used when ingesting files before the first file
+
+    Parameters
+    ----------
+    dbh : `DbbConnection`
+        Open database connection with write access to DBB tables
+    """
+    for sql in INGEST_STATEMENTS:
+        prepared_cursor(dbh, sql)
+
+
+def get_session_pool(db_config):
+    """Get the session pool of this process, creating it on first use
+
+    Parameters
+    ----------
+    db_config : `dict`
+        dictionary containing values needed to connect to DB (arguments
+        for cx_Oracle.makedsn plus optional pool_min, pool_max,
+        pool_increment and pool_wait_timeout_ms)
+
+    Returns
+    -------
+    pool : `cx_Oracle.SessionPool`
+        Pool from which DbbConnections are acquired
+
+    Notes
+    -----
+    A forked worker process cannot use its parent's sessions, so a new
+    pool is created the first time it is needed in each process.
+    """
+    global _pool, _pool_pid
+
+    if _pool is None or _pool_pid != os.getpid():
+        dsn_config = {key: val for key, val in db_config.items()
+                      if key not in POOL_CONFIG_KEYS and key != "call_timeout_ms"}
+        sizes = {key: db_config.get(key, default) for key, default in POOL_CONFIG_KEYS.items()}
+        dsn = cx_Oracle.makedsn(**dsn_config)
+        _log.debug("dsn = %s", dsn)
+        # no user/password in config, so use external authentication
+        # (which requires a heterogeneous pool).  threaded so the workers'
+        # connections can be used from more than one thread.
+        _pool = cx_Oracle.SessionPool(dsn=dsn, min=sizes["pool_min"], max=sizes["pool_max"],
+                                      increment=sizes["pool_increment"], threaded=True,
+                                      homogeneous=False, externalauth=True,
+                                      getmode=cx_Oracle.SPOOL_ATTRVAL_TIMEDWAIT,
+                                      connectiontype=DbbConnection)
+        _pool.wait_timeout = int(sizes["pool_wait_timeout_ms"])
+        _pool.stmtcachesize = STMT_CACHE_SIZE
+        _pool_pid = os.getpid()
+    return _pool
+
 
 def open_db_connection(db_config):
-    """Save to the database base information used for provenance
+    """Acquire a database connection from the session pool
 
     Parameters
     ----------
@@ -41,21 +453,42 @@ def open_db_connection(db_config):
 
     Returns
     -------
-    dbh : `cx_Oracle.Connection`
-        Open database connection to consolidated DB
+    dbh : `DbbConnection`
+        Open database connection to consolidated DB.  Closing it (or using
+        it as a context manager, ``with open_db_connection(db_config) as dbh:``)
+        releases the session back to the pool.  Each round-trip times out after
+        call_timeout_ms from db_config (see is_timeout).
     """
-    dsn = cx_Oracle.makedsn(**db_config)
-    logging.debug("dsn = %s", dsn)
-    dbh = cx_Oracle.connect(dsn=dsn)
+    pool = get_session_pool(db_config)
+    dbh = pool.acquire()
+    dbh.session_pool = pool
+    dbh.call_timeout = int(db_config.get("call_timeout_ms", DEFAULT_CALL_TIMEOUT_MS))
+    if dbh.stmtcachesize < STMT_CACHE_SIZE:
+        dbh.stmtcachesize = STMT_CACHE_SIZE
+    # none of the functions in this module commit, callers own the
+    # transaction boundaries (see commit_batch)
+    dbh.autocommit = False
     return dbh
 
 
+def commit_batch(dbh):
+    """Commit all the rows saved since the last commit
+
+    Parameters
+    ----------
+    dbh : `cx_Oracle.Connection`
+        Open database connection with write access to DBB tables
+    """
+    _log.debug("commit")
+    dbh.commit()
+
+
 def get_sequence_val(dbh, seqname):
     """Get the next value from a sequence
 
     Parameters
     ----------
-    dbh : `cx_Oracle.Connection`
+    dbh : `cx_Oracle.Connection` or `cx_Oracle.Cursor`
         Open database connection with write access to DBB tables
     seqname : `str`
         Name of sequence
@@ -65,9 +498,8 @@ def get_sequence_val(dbh, seqname):
     nextval : `int`
         Next value from the specified sequence
     """
-    curs = dbh.cursor()
-    sql = "select %s.nextval from DUAL" % seqname
-    curs.execute(sql)
+    curs = prepared_cursor(dbh, SQL_NEXTVAL % seqname)
+    curs.execute(None)
     nextval = curs.fetchone()[0]
     return nextval
 
@@ -77,7 +509,7 @@ def save_datastore_info(dbh, src_info, relpath, dataset_id):
 
     Parameters
     ----------
-    dbh : `cx_Oracle.Connection`
+    dbh : `cx_Oracle.Connection` or `cx_Oracle.Cursor`
         Open database connection with write access to DBB tables
     src_info : `dict`
         Dictionary containing information about the file
@@ -85,17 +517,105 @@ def save_datastore_info(dbh, src_info, relpath, dataset_id):
         Relative path of the file in the DBB
     dataset_id : `int`
         Dataset ID corresponding to this file (needed for table joins)
+
+    Raises
+    ------
+    cx_Oracle.IntegrityError
+        Raised if filename already exists in DBB (requires the UNIQUE
+        constraint on datastore_dbb.filename, see is_unique_violation)
     """
-    curs = dbh.cursor()
-    sql = ("insert into datastore_dbb (dataset_id, filename, relpath, filesize, chksum, chksum_type) "
-           "values (:dataset_id, :filename, :relpath, :filesize, :chksum, :chksum_type)")
-    logging.debug("sql = %s", sql)
-    curs.execute(sql, {"dataset_id": dataset_id,
-                       "filename": src_info["filename"],
-                       "relpath": relpath,
-                       "filesize": src_info["filesize"],
-                       "chksum": src_info["chksum"],
-                       "chksum_type": src_info["chksum_type"]})
+    curs = prepared_cursor(dbh, SQL_INSERT_DATASTORE)
+    _log.debug("sql = %s", SQL_INSERT_DATASTORE)
+    row = _datastore_row(src_info, relpath, dataset_id)
+    curs.setinputsizes(*_input_sizes(DATASTORE_INPUT_TYPES, [row]).values())
+    curs.execute(None, row)
+
+
+def _datastore_row(src_info, relpath, dataset_id):
+    """Create the bind values for a datastore_dbb row
+
+    Parameters
+    ----------
+    src_info : `dict`
+        Dictionary containing information about the file
+    relpath : `str`
+        Relative path of the file in the DBB
+    dataset_id : `int`
+        Dataset ID corresponding to this file (needed for table joins)
+
+    Returns
+    -------
+    row : `DatastoreRow`
+        Bind values for SQL_INSERT_DATASTORE
+    """
+    return DatastoreRow(dataset_id, src_info["filename"], relpath, src_info["filesize"],
+                        src_info["chksum"], src_info["chksum_type"])
+
+
+def is_unique_violation(err):
+    """Checks whether an exception was caused by a UNIQUE constraint violation
+
+    Parameters
+    ----------
+    err : `Exception`
+        Exception raised while executing SQL
+
+    Returns
+    -------
+    violation : `bool`
+        True if err is ORA-00001 (e.g., inserting a filename already in
+        datastore_dbb), otherwise False
+
+    Notes
+    -----
+    Duplicate filename detection relies on a UNIQUE index on the filename
+    column, e.g.,
+    ``alter table datastore_dbb add constraint datastore_dbb_filename_uk unique (filename)``
+    """
+    if not isinstance(err, cx_Oracle.IntegrityError):
+        return False
+    error, = err.args
+    return error.code == 1
+
+
+def is_timeout(err):
+    """Checks whether an exception was caused by a DB call timing out
+
+    Parameters
+    ----------
+    err : `Exception`
+        Exception raised while executing SQL
+
+    Returns
+    -------
+    timeout : `bool`
+        True if err is a call timeout (see open_db_connection) after which
+        the connection can still be used, otherwise False
+    """
+    if not isinstance(err, cx_Oracle.DatabaseError) or is_connection_broken(err):
+        return False
+    error, = err.args
+    return error.code in TIMEOUT_ERROR_CODES or error.message.startswith(TIMEOUT_ERROR_PREFIX)
+
+
+def is_connection_broken(err):
+    """Checks whether an exception means the connection can no longer be used
+
+    Parameters
+    ----------
+    err : `Exception`
+        Exception raised while executing SQL
+
+    Returns
+    -------
+    broken : `bool`
+        True if the session is gone (e.g., closed because a call timed out),
+        so nothing else (not even a rollback) can be done with the connection
+    """
+    if not isinstance(err, cx_Oracle.DatabaseError):
+        return False
+    error, = err.args
+    return error.code in BROKEN_ERROR_CODES or error.message.startswith(BROKEN_ERROR_PREFIX)
 
 
 def filename_exists_in_dbb(dbh, filename):
@@ -103,7 +623,7 @@ def filename_exists_in_dbb(dbh, filename):
 
     Parameters
     ----------
-    dbh : `cx_Oracle.Connection`
+    dbh : `cx_Oracle.Connection` or `cx_Oracle.Cursor`
         Open database connection with write access to DBB tables
     filename : `str`
         Name of file (no path) to search DBB for
@@ -112,11 +632,17 @@ def filename_exists_in_dbb(dbh, filename):
     -------
     exists : `bool`
         True if filename exists in DBB, otherwise False
+
+    Notes
+    -----
+    Only used when ingesting to tell a resent file (already in the DBB
+    registry) from a file on disk but not registered, most duplicates are
+    found when the batch is saved (see save_batch).
     """
-    curs = dbh.cursor()
-    sql = "select filename from datastore_dbb where filename=:filename"
-    logging.debug("sql = %s", sql)
-    curs.execute(sql, {"filename": filename})
+    # prefetch 2 rows so the fetch finds the end of the rows without another round-trip
+    curs = prepared_cursor(dbh, SQL_SELECT_FILENAME, prefetch=2)
+    _log.debug("sql = %s", SQL_SELECT_FILENAME)
+    curs.execute(None, {"filename": filename})
     row = curs.fetchone()
     return row is not None
 
@@ -126,7 +652,7 @@ def register_file_data(dbh, src_info):
 
     Parameters
     ----------
-    dbh : `cx_Oracle.Connection`
+    dbh : `cx_Oracle.Connection` or `cx_Oracle.Cursor`
         Open database connection with write access to DBB tables
     src_info : `dict`
         Dictionary containing information about the file
@@ -137,14 +663,59 @@ def register_file_data(dbh, src_info):
         New dataset id corresponding to dataset information stored in DBB's registry
     """
     # future version of this code is Gen3 Butler Registry code
-    dataset_id = get_sequence_val(dbh, "DATASET_SEQ")
-    curs = dbh.cursor()
-    sql = "insert into dataset (id, wgb_process_id, dataset_type) values (:id, :process_id, :dataset_type)"
-    logging.debug("sql = %s", sql)
-    curs.execute(sql, {"id": dataset_id,
-                       "process_id": src_info["process_id"],
-                       "dataset_type": src_info["dataset_type"]})
-    return dataset_id
+    curs = prepared_cursor(dbh, SQL_INSERT_DATASET_RETURNING)
+    _log.debug("sql = %s", SQL_INSERT_DATASET_RETURNING)
+    new_id = curs.var(int)
+    curs.execute(None, {"process_id": src_info["process_id"],
+                        "dataset_type": src_info["dataset_type"],
+                        "new_id": new_id})
+    return new_id.getvalue()[0]
+
+
+def save_batch(dbh, rows):
+    """Save the dataset and datastore entries for a batch of files and
+       update the end times of their processes in a single round-trip
+
+    Parameters
+    ----------
+    dbh : `cx_Oracle.Connection` or `cx_Oracle.Cursor`
+        Open database connection with write access to DBB tables
+    rows : `list` [`tuple`]
+        (src_info, relpath) for each file
+
+    Returns
+    -------
+    errors : `list` [`RowError`]
+        Files whose datastore rows could not be inserted (e.g., code 1 if the
+        filename already exists in DBB).  If not empty, nothing else about
+        the batch should be committed.
+    """
+    src_infos = [src_info for src_info, _ in rows]
+    columns = {"process_ids": (int, "process_id"),
+               "dataset_types": (str, "dataset_type"),
+               "filenames": (str, "filename"),
+               "filesizes": (int, "filesize"),
+               "chksums": (str, "chksum"),
+               "chksum_types": (str, "chksum_type")}
+
+    curs = prepared_cursor(dbh, PLSQL_SAVE_BATCH)
+    _log.debug("sql = %s", PLSQL_SAVE_BATCH)
+    binds = {}
+    for name, (typ, key) in columns.items():
+        values = [src_info[key] for src_info in src_infos]
+        binds[name] = (curs.arrayvar(typ, values, _bind_size(values)) if typ is str
+                       else curs.arrayvar(typ, values))
+    relpaths = [relpath for _, relpath in rows]
+    binds["relpaths"] = curs.arrayvar(str, relpaths, _bind_size(relpaths))
+    binds["end_process_ids"] = curs.arrayvar(int, sorted({src_info["process_id"] for src_info in src_infos}))
+    binds["error_offsets"] = curs.arrayvar(int, len(rows))
+    binds["error_codes"] = curs.arrayvar(int, len(rows))
+    binds["error_msgs"] = curs.arrayvar(str, len(rows), BATCH_ERROR_MSG_LEN)
+    curs.execute(None, binds)
+
+    return [RowError(*error) for error in zip(binds["error_offsets"].getvalue(),
+                                              binds["error_codes"].getvalue(),
+                                              binds["error_msgs"].getvalue())]
 
 
 def save_end_time(dbh, process_id):
@@ -152,15 +723,14 @@ def save_end_time(dbh, process_id):
 
     Parameters
     ----------
-    dbh : `cx_Oracle.Connection`
+    dbh : `cx_Oracle.Connection` or `cx_Oracle.Cursor`
         Open database connection with write access to DBB tables
     process_id : `int`
         ID of the process for which to update the end time
     """
-    curs = dbh.cursor()
-    sql = "update process set end_time=SYSTIMESTAMP where id=:id"
-    logging.debug("sql = %s", sql)
-    curs.execute(sql, {"id": process_id})
+    curs = prepared_cursor(dbh, SQL_UPDATE_END_TIME)
+    _log.debug("sql = %s", SQL_UPDATE_END_TIME)
+    curs.execute(None, {"id": process_id})
 
 
 def save_bad_file_db(dbh, bad_info, src_info):
@@ -168,7 +738,7 @@ def save_bad_file_db(dbh, bad_info, src_info):
 
     Parameters
     ----------
-    dbh : `cx_Oracle.Connection`
+    dbh : `cx_Oracle.Connection` or `cx_Oracle.Cursor`
         Open database connection with write access to DBB tables
     bad_info : `dict`
         Dictionary containing extra information about the file including
@@ -176,28 +746,22 @@ def save_bad_file_db(dbh, bad_info, src_info):
         required keys = uniq_filename, relpath, disk_usage, rejected_msg, rejected_date
     src_info : `dict`
         Dictionary containing information about the original file
-        required keys = filename, dataset_type, filesize, chksum, chksum_type
+        used keys = filename, dataset_type, filesize, chksum, chksum_type,
+        process_id (missing values are saved as NULL)
     """
-    logging.debug("save_bad_file_db: bad_info = %s", bad_info)
-    logging.debug("save_bad_file_db: src_info = %s", src_info)
-    data = {}
-    if src_info is not None:
-        copyvals = ["filename", "dataset_type", "filesize", "chksum", "chksum_type"]
-        for val in copyvals:
-            data[val] = src_info[val]
-        data["file_registration_process_id"] = src_info["process_id"]
-
-    copyvals = ["uniq_filename", "relpath", "disk_usage", "rejected_msg", "rejected_date"]
-    for val in copyvals:
-        data[val] = bad_info[val]
-    logging.debug("bad file db row info = %s", data)
-
-    cols = data.keys()
-    sql = "insert into dbb_bad_file (%s) values (:%s)" % (",".join(cols), ",:".join(cols))
-    curs = dbh.cursor()
-    logging.debug("sql = %s", sql)
-    curs.execute(sql, data)
-    dbh.commit()
+    if _log.isEnabledFor(logging.DEBUG):
+        _log.debug("save_bad_file_db: bad_info = %s", bad_info)
+    if src_info is None:
+        src_info = {}
+    row = BadFileRow(*[src_info.get(val) for val in BAD_FILE_SRC_COLS], src_info.get("process_id"),
+                     *[bad_info[val] for val in BAD_FILE_INFO_COLS])
+    if _log.isEnabledFor(logging.DEBUG):
+        _log.debug("bad file db row info = %s", row)
+
+    curs = prepared_cursor(dbh, SQL_INSERT_BAD_FILE)
+    _log.debug("sql = %s", SQL_INSERT_BAD_FILE)
+    curs.setinputsizes(*_input_sizes(BAD_FILE_INPUT_TYPES, [row]).values())
+    curs.execute(None, row)
 
 
 def get_registration_process_id(dbh, uuid):
@@ -205,7 +769,7 @@ def get_registration_process_id(dbh, uuid):
 
     Parameters
     ----------
-    dbh : `cx_Oracle.Connection`
+    dbh : `cx_Oracle.Connection` or `cx_Oracle.Cursor`
         Open database connection with write access to DBB tables
     uuid : `str`
         ID currently used to group the saving of multiple files into single
@@ -216,12 +780,11 @@ def get_registration_process_id(dbh, uuid):
     process_id : `int` or None
         Process id to be used for provenance
     """
-    curs = dbh.cursor()
+    curs = prepared_cursor(dbh, SQL_SELECT_REGISTRATION_PROCESS)
 
     process_id = None
-    sql = "select file_registration_process_id from file_registration_lookup where uuid=:uuid"
-    logging.debug("sql = %s", sql)
-    curs.execute(sql, {"uuid": uuid})
+    _log.debug("sql = %s", SQL_SELECT_REGISTRATION_PROCESS)
+    curs.execute(None, {"uuid": uuid})
     row = curs.fetchone()
     if row is not None:
         process_id = row[0]
@@ -234,7 +797,7 @@ def create_new_process(dbh, info):
 
     Parameters
     ----------
-    dbh : `cx_Oracle.Connection`
+    dbh : `cx_Oracle.Connection` or `cx_Oracle.Cursor`
         Open database connection with write access to DBB tables
     info : `dict`
         Information about process that staged files to DBB gateway
@@ -244,19 +807,16 @@ def create_new_process(dbh, info):
     -------
     The newly created process id to be used in provenance
     """
-    process_id = get_sequence_val(dbh, "PROCESS_SEQ")
+    curs = prepared_cursor(dbh, SQL_INSERT_PROCESS)
+    _log.debug("sql = %s", SQL_INSERT_PROCESS)
+    new_id = curs.var(int)
+    curs.execute(None, {"name": info["exec_name"],
+                        "exec_host": info["exec_host"],
+                        "info_table": "file_registration",
+                        "start_time": float(info["timestamp"]),
+                        "new_id": new_id})
 
-    curs = dbh.cursor()
-    sql = ("insert into process (ID, NAME, INFO_TABLE, EXEC_HOST, START_TIME, ROOT_PROCESS_ID) "
-           "values (:id, :name, :info_table, :exec_host, :start_time, :id)")
-    logging.debug("sql = %s", sql)
-    curs.execute(sql, {"id": process_id,
-                       "name": info["exec_name"],
-                       "exec_host": info["exec_host"],
-                       "info_table": "file_registration",
-                       "start_time": datetime.fromtimestamp(info["timestamp"])})
-
-    return process_id
+    return new_id.getvalue()[0]
 
 
 def save_registration_info(dbh, src_info):
@@ -264,7 +824,7 @@ def save_registration_info(dbh, src_info):
 
     Parameters
     ----------
-    dbh : `cx_Oracle.Connection`
+    dbh : `cx_Oracle.Connection` or `cx_Oracle.Cursor`
         Open database connection with write access to DBB tables
     src_info : `dict`
         dictionary containing information specific to this ingestion
@@ -273,23 +833,16 @@ def save_registration_info(dbh, src_info):
     -------
     The newly created process id to be used in provenance
     """
-    process_id = create_new_process(dbh, src_info)
-
-    curs = dbh.cursor()
-
-    sql = ("insert into file_registration (PROCESS_ID, USERNAME, PROV_MSG) values "
-           "(:process_id, :username, :provmsg)")
-    logging.debug("sql = %s", sql)
-    curs.execute(sql, {"process_id": process_id,
-                       "username": src_info["user"],
-                       "provmsg": src_info["prov_msg"]})
-
-    sql = ("insert into file_registration_lookup (UUID, FILE_REGISTRATION_PROCESS_ID) values "
-           "(:uuid, :process_id)")
-    logging.debug("sql = %s", sql)
-    curs.execute(sql, {"uuid": src_info["uuid"],
-                       "process_id": process_id})
-
-    dbh.commit()
-
-    return process_id
+    # same rows as create_new_process plus the registration inserts, in one block
+    curs = prepared_cursor(dbh, PLSQL_SAVE_REGISTRATION)
+    _log.debug("sql = %s", PLSQL_SAVE_REGISTRATION)
+    process_id = curs.var(int)
+    curs.execute(None, {"name": src_info["exec_name"],
+                        "exec_host": src_info["exec_host"],
+                        "start_time": float(src_info["timestamp"]),
+                        "process_id": process_id,
+                        "username": src_info["user"],
+                        "provmsg": src_info["prov_msg"],
+                        "uuid": src_info["uuid"]})
+
+    return process_id.getvalue()
@@ -0,0 +1,80 @@
+# This file is part of dbb_gateway.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Helpers shared by the tests
+
+Importing this module makes db_funcs importable where cx_Oracle is not
+installed (only the functions that do not talk to a database can then be
+tested).
+"""
+import importlib.util
+import os
+import sys
+import types
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      "bin.src", "dbb_ingest_ats.py")
+
+
+def _install_cx_oracle_stub():
+    """Install a minimal cx_Oracle module if the real one is missing"""
+    try:
+        import cx_Oracle  # noqa: F401
+        return
+    except ImportError:
+        pass
+
+    stub = types.ModuleType("cx_Oracle")
+
+    class DatabaseError(Exception):
+        pass
+
+    class IntegrityError(DatabaseError):
+        pass
+
+    stub.Connection = type("Connection", (), {})
+    stub.Cursor = type("Cursor", (), {})
+    stub.SessionPool = type("SessionPool", (), {})
+    stub._Error = type("_Error", (), {})
+    stub.DatabaseError = DatabaseError
+    stub.IntegrityError = IntegrityError
+    stub.SPOOL_ATTRVAL_TIMEDWAIT = 3
+    stub.makedsn = lambda *args, **kwargs: "dsn"
+    sys.modules["cx_Oracle"] = stub
+
+
+def load_script():
+    """Import bin.src/dbb_ingest_ats.py as module dbb_ingest_ats
+
+    Returns
+    -------
+    module : `module`
+        The ingest script module (imported once)
+    """
+    if "dbb_ingest_ats" not in sys.modules:
+        spec = importlib.util.spec_from_file_location("dbb_ingest_ats", SCRIPT)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["dbb_ingest_ats"] = module
+        spec.loader.exec_module(module)
+    return sys.modules["dbb_ingest_ats"]
+
+
+_install_cx_oracle_stub()
@@ -0,0 +1,177 @@
+# This file is part of dbb_gateway.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for chksum_funcs"""
+import errno
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from lsst.dbb.gateway import chksum_funcs
+
+# small tree segments so test files span several segments
+SEGMENT_SIZE = 1024
+
+
+class ChksumTestCase(unittest.TestCase):
+    """Base class creating files in a temporary directory"""
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def make_file(self, name, data, mode=0o640, mtime_ns=1_500_000_000_123_456_789):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, "wb") as fh:
+            fh.write(data)
+        os.chmod(path, mode)
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+        return path
+
+
+def expected_tree(data, hash_name="md5"):
+    """Tree chksum of data calculated directly from its definition"""
+    digests = b"".join(hashlib.new(hash_name, data[offset:offset + SEGMENT_SIZE]).digest()
+                       for offset in range(0, len(data), SEGMENT_SIZE))
+    return hashlib.new(hash_name, digests).hexdigest()
+
+
+class CalcChksumTestCase(ChksumTestCase):
+    def test_matches_hashlib(self):
+        data = os.urandom(3 * 1000 + 17)
+        path = self.make_file("data", data)
+        for chksum_type in ("md5", "sha1", "sha256"):
+            expected = hashlib.new(chksum_type, data).hexdigest()
+            self.assertEqual(chksum_funcs.calc_chksum(path, chksum_type, blksize=1000), expected)
+            self.assertEqual(chksum_funcs.calc_chksum(chksum_type=chksum_type, data=data), expected)
+
+    def test_empty_file(self):
+        path = self.make_file("empty", b"")
+        self.assertEqual(chksum_funcs.calc_chksum(path), hashlib.md5(b"").hexdigest())
+
+
+class ChksumTypesTestCase(ChksumTestCase):
+    def test_sha256(self):
+        data = os.urandom(5000)
+        path = self.make_file("data", data)
+        self.assertEqual(chksum_funcs.calc_chksum(path, "sha256"), hashlib.sha256(data).hexdigest())
+
+    @unittest.skipIf(chksum_funcs.google_crc32c is None, "google-crc32c is not installed")
+    def test_crc32c(self):
+        # standard crc32c check value
+        path = self.make_file("data", b"123456789")
+        self.assertEqual(chksum_funcs.calc_chksum(path, "crc32c", blksize=4), "e3069283")
+
+    @mock.patch.object(chksum_funcs, "google_crc32c", None)
+    def test_crc32c_missing(self):
+        with self.assertRaises(ValueError):
+            chksum_funcs.new_hasher("crc32c")
+
+
+@mock.patch.object(chksum_funcs, "TREE_SEGMENT_SIZE", SEGMENT_SIZE)
+class TreeChksumTestCase(ChksumTestCase):
+    def check_tree(self, data):
+        expected = expected_tree(data)
+        path = self.make_file("data", data)
+        for nworkers in (1, 3):
+            self.assertEqual(chksum_funcs.calc_chksum_parallel(path, "md5_tree", nworkers), expected)
+        self.assertEqual(chksum_funcs.calc_chksum(path, "md5_tree"), expected)
+        self.assertEqual(chksum_funcs.calc_chksum(chksum_type="md5_tree", data=data), expected)
+
+        # incremental hasher fed in pieces not aligned with the segments
+        hasher = chksum_funcs.new_hasher("md5_tree")
+        for offset in range(0, len(data), 700):
+            hasher.update(data[offset:offset + 700])
+        self.assertEqual(hasher.digest().hex(), expected)
+
+    def test_several_segments(self):
+        self.check_tree(os.urandom(5 * SEGMENT_SIZE + 123))
+
+    def test_whole_segments(self):
+        self.check_tree(os.urandom(4 * SEGMENT_SIZE))
+
+    def test_empty_file(self):
+        self.check_tree(b"")
+
+    def test_differs_from_plain_chksum(self):
+        data = os.urandom(2 * SEGMENT_SIZE)
+        path = self.make_file("data", data)
+        self.assertNotEqual(chksum_funcs.calc_chksum(path, "md5_tree"), hashlib.md5(data).hexdigest())
+
+
+class CopyAndHashTestCase(ChksumTestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = os.urandom(10 * 1000 + 1)
+        self.src = self.make_file("src", self.data)
+        self.dst = os.path.join(self.tmpdir.name, "dst")
+
+    def check_copy(self):
+        with open(self.dst, "rb") as fh:
+            self.assertEqual(fh.read(), self.data)
+        src_stat = os.stat(self.src)
+        dst_stat = os.stat(self.dst)
+        self.assertEqual(dst_stat.st_mode, src_stat.st_mode)
+        self.assertEqual(dst_stat.st_mtime_ns, src_stat.st_mtime_ns)
+
+    def test_chksums(self):
+        for chksum_type in ("md5", "sha256", "md5_tree"):
+            with self.subTest(chksum_type=chksum_type):
+                chksum = chksum_funcs.copy_and_hash(self.src, self.dst, chksum_type, bufsize=1000)
+                self.assertEqual(chksum, chksum_funcs.calc_chksum(self.src, chksum_type))
+                self.check_copy()
+                os.remove(self.dst)
+
+    def test_no_chksum(self):
+        self.assertIsNone(chksum_funcs.copy_and_hash(self.src, self.dst))
+        self.check_copy()
+
+    def test_kernel_copy_fallbacks(self):
+        unsupported = OSError(errno.EXDEV, "unsupported")
+        with mock.patch.object(chksum_funcs.os, "copy_file_range", side_effect=unsupported,
+                               create=True) as copy_file_range:
+            chksum_funcs.copy_and_hash(self.src, self.dst)
+            self.check_copy()
+            self.assertTrue(copy_file_range.called)
+            os.remove(self.dst)
+            with mock.patch.object(chksum_funcs.os, "sendfile", side_effect=unsupported) as sendfile:
+                chksum_funcs.copy_and_hash(self.src, self.dst)
+                self.check_copy()
+                self.assertTrue(sendfile.called)
+
+    def test_empty_file(self):
+        self.src = self.make_file("empty", b"")
+        self.data = b""
+        self.assertEqual(chksum_funcs.copy_and_hash(self.src, self.dst, "md5"), hashlib.md5(b"").hexdigest())
+        self.check_copy()
+
+    def test_existing_dst(self):
+        self.make_file("dst", b"original")
+        for chksum_type in ("md5", None):
+            with self.assertRaises(FileExistsError):
+                chksum_funcs.copy_and_hash(self.src, self.dst, chksum_type)
+        with open(self.dst, "rb") as fh:
+            self.assertEqual(fh.read(), b"original")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+# This file is part of dbb_gateway.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the db_funcs functions that do not need a database"""
+import gc
+import threading
+import unittest
+import weakref
+from datetime import datetime
+from unittest import mock
+
+import gateway_test_utils  # noqa: F401 (cx_Oracle stand-in if not installed)
+from lsst.dbb.gateway import db_funcs
+
+
+class BindSizeTestCase(unittest.TestCase):
+    def test_rounded_up_to_steps(self):
+        self.assertEqual(db_funcs._bind_size(["a", "abc"]), 32)
+        self.assertEqual(db_funcs._bind_size(["a" * 32]), 32)
+        self.assertEqual(db_funcs._bind_size(["a" * 33]), 128)
+        self.assertEqual(db_funcs._bind_size(["a" * 129, "b"]), 2000)
+        self.assertEqual(db_funcs._bind_size(["a" * 2001]), 4000)
+
+    def test_longer_than_steps(self):
+        self.assertEqual(db_funcs._bind_size(["a" * 4001]), 4001)
+
+    def test_no_values(self):
+        self.assertEqual(db_funcs._bind_size([]), 32)
+        self.assertEqual(db_funcs._bind_size([None, None]), 32)
+        self.assertEqual(db_funcs._bind_size([None, "a" * 100]), 128)
+
+
+class InputSizesTestCase(unittest.TestCase):
+    def test_datastore_rows(self):
+        rows = [db_funcs.DatastoreRow(1, "f" * 40, "r" * 10, 5, "c" * 32, "md5"),
+                db_funcs.DatastoreRow(2, "f", "r" * 200, 6, "c" * 64, "sha256")]
+        sizes = db_funcs._input_sizes(db_funcs.DATASTORE_INPUT_TYPES, rows)
+        self.assertEqual(list(sizes), list(db_funcs.DatastoreRow._fields))
+        self.assertEqual(sizes, {"dataset_id": int, "filename": 128, "relpath": 2000, "filesize": int,
+                                 "chksum": 128, "chksum_type": 32})
+
+    def test_bad_file_row_with_nulls(self):
+        row = db_funcs.BadFileRow(None, None, None, None, None, None, "u" * 300, "bad/u", 10,
+                                  "message", datetime(2020, 1, 2))
+        sizes = db_funcs._input_sizes(db_funcs.BAD_FILE_INPUT_TYPES, [row])
+        self.assertEqual(list(sizes), db_funcs.BAD_FILE_COLS)
+        self.assertEqual(list(sizes.values()), [32, 32, int, 32, 32, int, 2000, 32, int, 32, datetime])
+
+
+class FakeConnection:
+    """Connection creating mock cursors"""
+    def cursor(self):
+        return mock.Mock()
+
+
+class PreparedCursorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dbh = FakeConnection()
+        self.addCleanup(db_funcs.reset_cursor, self.dbh)
+
+    def test_cursor_reused(self):
+        curs = db_funcs.prepared_cursor(self.dbh, "select 1 from DUAL")
+        curs.prepare.assert_called_once_with("select 1 from DUAL")
+        self.assertIs(db_funcs.prepared_cursor(self.dbh, "select 1 from DUAL"), curs)
+        self.assertEqual(curs.prepare.call_count, 1)
+        self.assertIsNot(db_funcs.prepared_cursor(self.dbh, "select 2 from DUAL"), curs)
+        other_dbh = FakeConnection()
+        self.assertIsNot(db_funcs.prepared_cursor(other_dbh, "select 1 from DUAL"), curs)
+        db_funcs.reset_cursor(other_dbh)
+
+    def test_per_thread(self):
+        curs = db_funcs.prepared_cursor(self.dbh, "select 1 from DUAL")
+        other = []
+
+        def prepare_in_thread():
+            other.append(db_funcs.prepared_cursor(self.dbh, "select 1 from DUAL"))
+
+        thread = threading.Thread(target=prepare_in_thread)
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], curs)
+        self.assertIs(db_funcs.prepared_cursor(self.dbh, "select 1 from DUAL"), curs)
+
+    def test_reset_cursor(self):
+        curs = db_funcs.prepared_cursor(self.dbh, "select 1 from DUAL")
+        db_funcs.reset_cursor(self.dbh)
+        curs.close.assert_called_once_with()
+        self.assertIsNot(db_funcs.prepared_cursor(self.dbh, "select 1 from DUAL"), curs)
+
+    def test_reset_releases_connection(self):
+        dbh = FakeConnection()
+        db_funcs.prepared_cursor(dbh, "select 1 from DUAL")
+        ref = weakref.ref(dbh)
+        db_funcs.reset_cursor(dbh)
+        del dbh
+        gc.collect()
+        self.assertIsNone(ref())
+
+
+if __name__ == "__main__":
+    unittest.main()
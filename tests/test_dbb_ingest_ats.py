@@ -0,0 +1,356 @@
+# This file is part of dbb_gateway.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the dbb_ingest_ats functions that do not need a database"""
+import errno
+import io
+import logging
+import mmap
+import os
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+from astropy.io import fits
+
+import gateway_test_utils
+
+dbb_ingest_ats = gateway_test_utils.load_script()
+
+
+class IngestTestCase(unittest.TestCase):
+    """Base class creating files in a temporary directory"""
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def make_file(self, name, data=b"data", mtime=None):
+        path = os.path.join(self.tmpdir.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fh:
+            fh.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+
+class HandleBadFileTestCase(IngestTestCase):
+    def setUp(self):
+        super().setUp()
+        self.config = {"bad_file_dir": os.path.join(self.tmpdir.name, "bad")}
+        patcher = mock.patch.object(dbb_ingest_ats.db_funcs, "save_bad_file_db")
+        self.save_bad_file_db = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def check_bad_file(self, tar_filename, src_info):
+        with self.assertLogs(dbb_ingest_ats._log, logging.DEBUG):
+            dbb_ingest_ats.handle_bad_file(self.config, "dbh", tar_filename, src_info, "bad data")
+        self.assertFalse(os.path.exists(tar_filename))
+        (dbh, bad_info, saved_src_info), _ = self.save_bad_file_db.call_args
+        self.assertEqual(dbh, "dbh")
+        self.assertIs(saved_src_info, src_info)
+        self.assertEqual(bad_info["uniq_filename"], "file.tar")
+        self.assertEqual(bad_info["disk_usage"], 4)
+        self.assertEqual(bad_info["rejected_msg"], "bad data")
+        self.assertTrue(os.path.exists(os.path.join(self.config["bad_file_dir"], bad_info["relpath"],
+                                                    "file.tar")))
+        return bad_info
+
+    def test_without_src_info(self):
+        tar_filename = self.make_file("delivery/file.tar", mtime=1600000000)
+        bad_info = self.check_bad_file(tar_filename, None)
+        self.assertEqual(bad_info["delivery_date"].timestamp(), 1600000000)
+
+    def test_with_src_info(self):
+        tar_filename = self.make_file("delivery/file.tar")
+        src_info = {"tar_filename": tar_filename, "dataset_type": "raw", "timestamp": 1500000000}
+        bad_info = self.check_bad_file(tar_filename, src_info)
+        self.assertEqual(bad_info["delivery_date"].timestamp(), 1500000000)
+
+
+class ObservingNiteTestCase(unittest.TestCase):
+    def test_obs_nite(self):
+        header = {"OBS-NITE": "20200101", "DATE-OBS": "2020-02-03T20:00:00.0"}
+        self.assertEqual(dbb_ingest_ats.get_observing_nite(header), "20200101")
+
+    def test_after_14h(self):
+        for date_obs in ("2020-02-03T14:00:00.000", "2020-02-03T23:59:59.9", "2020-02-03T18:30:00"):
+            self.assertEqual(dbb_ingest_ats.get_observing_nite({"DATE-OBS": date_obs}), "20200203")
+
+    def test_before_14h(self):
+        self.assertEqual(dbb_ingest_ats.get_observing_nite({"DATE-OBS": "2020-02-03T13:59:59.999"}),
+                         "20200202")
+        self.assertEqual(dbb_ingest_ats.get_observing_nite({"DATE-OBS": "2020-03-01T00:00:00.0"}),
+                         "20200229")
+        self.assertEqual(dbb_ingest_ats.get_observing_nite({"DATE-OBS": "2021-01-01T05:00:00"}),
+                         "20201231")
+
+    def test_date_only(self):
+        self.assertEqual(dbb_ingest_ats.get_observing_nite({"DATE-OBS": "2020-02-03"}), "20200203")
+
+
+def make_fits_data(**cards):
+    """Contents of a FITS file with a small image and the given header cards"""
+    hdu = fits.PrimaryHDU(numpy.arange(100, dtype=numpy.int16).reshape(10, 10))
+    for key, value in cards.items():
+        hdu.header[key] = value
+    # "END" followed by 77 spaces, but not on a card boundary
+    hdu.header["COMMENT"] = "END"
+    hdu.header.add_blank("")
+    buf = io.BytesIO()
+    hdu.writeto(buf)
+    return buf.getvalue()
+
+
+class ReadFitsHeaderTestCase(IngestTestCase):
+    def test_buffer(self):
+        data = make_fits_data(OBJECT="END", **{"DATE-OBS": "2020-02-03T20:00:00.0"})
+        self.assertTrue(data.find(dbb_ingest_ats.FITS_END_CARD) % dbb_ingest_ats.FITS_CARD_LEN)
+        header = dbb_ingest_ats.read_fits_header(data)
+        self.assertEqual(header["OBJECT"], "END")
+        self.assertEqual(header["DATE-OBS"], "2020-02-03T20:00:00.0")
+        self.assertEqual(header["NAXIS1"], 10)
+
+        path = self.make_file("raw.fits", data)
+        with open(path, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            self.assertEqual(dict(dbb_ingest_ats.read_fits_header(mapped)), dict(header))
+        self.assertEqual(dict(dbb_ingest_ats.read_fits_header(path)), dict(header))
+
+    def test_no_end_card(self):
+        data = make_fits_data()
+        card_len = dbb_ingest_ats.FITS_CARD_LEN
+        end = next(offset for offset in range(0, len(data), card_len)
+                   if data[offset:offset + card_len] == dbb_ingest_ats.FITS_END_CARD)
+        with self.assertRaises(ValueError):
+            dbb_ingest_ats.read_fits_header(data[:end])
+
+
+class ReadDigestTestCase(unittest.TestCase):
+    def test_contents(self):
+        expected = {"raw.fits": "abc123", "raw.info": "def456"}
+        data = "abc123\traw.fits\n def456 \t raw.info \n"
+        self.assertEqual(dbb_ingest_ats.read_digest(data), expected)
+        self.assertEqual(dbb_ingest_ats.read_digest(data.encode()), expected)
+        self.assertEqual(dbb_ingest_ats.read_digest(io.StringIO(data)), expected)
+
+    def test_delim(self):
+        self.assertEqual(dbb_ingest_ats.read_digest(b"abc123  raw.fits\n", delim="  "),
+                         {"raw.fits": "abc123"})
+
+
+class ReadTarballTestCase(IngestTestCase):
+    def make_tarball(self, name, mode="w"):
+        members = {"raw.fits": b"fits data", "raw.info": b"filename: raw.fits\n",
+                   "raw.digest": b"abc\traw.fits\n"}
+        tar_filename = os.path.join(self.tmpdir.name, name)
+        with tarfile.open(tar_filename, mode) as tar:
+            subdir = tarfile.TarInfo("subdir")
+            subdir.type = tarfile.DIRTYPE
+            tar.addfile(subdir)
+            for member_name, data in members.items():
+                info = tarfile.TarInfo(member_name)
+                info.size = len(data)
+                info.mode = 0o600
+                info.mtime = 1500000000
+                tar.addfile(info, io.BytesIO(data))
+        return tar_filename
+
+    def check_tarball(self, tar_filename):
+        outputdir = os.path.join(self.tmpdir.name, "scratch")
+        os.mkdir(outputdir)
+        filename, data_fname, info_fname, info_data, digest_data = \
+            dbb_ingest_ats.read_tarball(tar_filename, outputdir)
+        self.assertEqual(filename, "raw.fits")
+        self.assertEqual(data_fname, os.path.join(outputdir, "raw.fits"))
+        self.assertEqual(info_fname, "raw.info")
+        self.assertEqual(info_data, b"filename: raw.fits\n")
+        self.assertEqual(digest_data, b"abc\traw.fits\n")
+
+        # only the raw file is written, with its archived mode and mtime
+        self.assertEqual(os.listdir(outputdir), ["raw.fits"])
+        with open(data_fname, "rb") as fh:
+            self.assertEqual(fh.read(), b"fits data")
+        self.assertEqual(os.stat(data_fname).st_mode & 0o777, 0o600)
+        self.assertEqual(os.stat(data_fname).st_mtime, 1500000000)
+
+    def test_tar(self):
+        self.check_tarball(self.make_tarball("file.tar"))
+
+    def test_gzipped_tar(self):
+        self.check_tarball(self.make_tarball("file.tar.gz", "w:gz"))
+
+
+class ListTarballsTestCase(IngestTestCase):
+    def test_only_tarballs(self):
+        delivery_dir = os.path.join(self.tmpdir.name, "delivery")
+        expected = [self.make_file("delivery/file%s.tar" % num, mtime=1500000000 + num) for num in range(3)]
+        self.make_file("delivery/file.tar.part")
+        self.make_file("delivery/notes.txt")
+        os.mkdir(os.path.join(delivery_dir, "dir.tar"))
+        self.assertEqual(sorted(dbb_ingest_ats.get_list_tarballs(delivery_dir)), expected)
+
+    def test_mtime_order(self):
+        delivery_dir = os.path.join(self.tmpdir.name, "delivery")
+        # same second, different nanoseconds, and two with equal mtimes (ordered by path)
+        mtimes_ns = {"c.tar": 1500000000_000000001, "a.tar": 1500000000_000000002,
+                     "d.tar": 1500000001_000000000, "b.tar": 1500000000_000000002,
+                     "e.tar": 1400000000_000000000}
+        for name, mtime_ns in mtimes_ns.items():
+            os.utime(self.make_file("delivery/" + name), ns=(mtime_ns, mtime_ns))
+        self.assertEqual([os.path.basename(path) for path in dbb_ingest_ats.get_list_tarballs(delivery_dir)],
+                         ["e.tar", "c.tar", "a.tar", "b.tar", "d.tar"])
+
+    def test_empty(self):
+        os.mkdir(os.path.join(self.tmpdir.name, "delivery"))
+        self.assertEqual(dbb_ingest_ats.get_list_tarballs(os.path.join(self.tmpdir.name, "delivery")), [])
+
+    def test_missing_dir(self):
+        with self.assertRaises(FileNotFoundError):
+            dbb_ingest_ats.get_list_tarballs(os.path.join(self.tmpdir.name, "missing"))
+
+
+class MoveFileToDbbTestCase(IngestTestCase):
+    def setUp(self):
+        super().setUp()
+        self.make_src()
+        self.chksum = dbb_ingest_ats.chksum_funcs.calc_chksum(self.src, "md5")
+        self.dst = os.path.join(self.tmpdir.name, "dbb", "raw", "raw.fits")
+
+    def make_src(self):
+        self.src = self.make_file("scratch/raw.fits", b"fits data", mtime=1500000000)
+        self.src_stat = os.stat(self.src)
+
+    def check_moved(self):
+        self.assertFalse(os.path.exists(self.src))
+        with open(self.dst, "rb") as fh:
+            self.assertEqual(fh.read(), b"fits data")
+        self.assertEqual(os.stat(self.dst).st_mtime, 1500000000)
+
+    def test_link(self):
+        dbb_ingest_ats.move_file_to_dbb(self.src, self.chksum, "md5", self.dst)
+        self.check_moved()
+        self.assertEqual(os.stat(self.dst).st_ino, self.src_stat.st_ino)
+
+    def test_link_bad_chksum(self):
+        with self.assertRaises(IOError):
+            dbb_ingest_ats.move_file_to_dbb(self.src, "bad", "md5", self.dst)
+        self.assertFalse(os.path.exists(self.dst))
+
+    def test_link_fallback(self):
+        for link_errno in sorted(dbb_ingest_ats.LINK_FALLBACK_ERRNOS):
+            with self.subTest(errno=errno.errorcode[link_errno]):
+                with mock.patch.object(dbb_ingest_ats.os, "link",
+                                       side_effect=OSError(link_errno, os.strerror(link_errno))), \
+                        self.assertLogs(dbb_ingest_ats._log, logging.INFO):
+                    dbb_ingest_ats.move_file_to_dbb(self.src, self.chksum, "md5", self.dst)
+                self.check_moved()
+                self.assertEqual(os.stat(self.dst).st_mode, self.src_stat.st_mode)
+                self.assertNotEqual(os.stat(self.dst).st_ino, self.src_stat.st_ino)
+                os.remove(self.dst)
+                self.make_src()
+
+    def test_link_error(self):
+        denied = PermissionError(errno.EACCES, "denied")
+        with mock.patch.object(dbb_ingest_ats.os, "link", side_effect=denied):
+            with self.assertRaises(PermissionError):
+                dbb_ingest_ats.move_file_to_dbb(self.src, self.chksum, "md5", self.dst)
+        self.assertTrue(os.path.exists(self.src))
+        self.assertFalse(os.path.exists(self.dst))
+
+    def test_existing_dst(self):
+        self.make_file("dbb/raw/raw.fits", b"original")
+        with self.assertRaises(FileExistsError):
+            dbb_ingest_ats.move_file_to_dbb(self.src, self.chksum, "md5", self.dst)
+        self.assertTrue(os.path.exists(self.src))
+        with open(self.dst, "rb") as fh:
+            self.assertEqual(fh.read(), b"original")
+
+
+class SaveEntriesTestCase(IngestTestCase):
+    def setUp(self):
+        super().setUp()
+        self.mocks = {}
+        for name, module in (("save_batch_db", dbb_ingest_ats), ("handle_bad_file", dbb_ingest_ats),
+                             ("filename_exists_in_dbb", dbb_ingest_ats.db_funcs),
+                             ("commit_batch", dbb_ingest_ats.db_funcs)):
+            patcher = mock.patch.object(module, name)
+            self.mocks[name] = patcher.start()
+            self.addCleanup(patcher.stop)
+        self.mocks["filename_exists_in_dbb"].return_value = False
+
+    def make_entry(self, filename, tar_filename, resent=False):
+        src_info = {"filename": filename, "tar_filename": tar_filename}
+        if resent:
+            return {"src_info": src_info, "relpath": None, "fullname": None,
+                    "exists_msg": "FileExistsError: Consistency error"}
+        return {"src_info": src_info, "relpath": "raw/" + filename,
+                "fullname": self.make_file("dbb/raw/" + filename)}
+
+    def test_resent_in_pending_batch(self):
+        first = self.make_entry("a.fits", "1.tar")
+        resent = self.make_entry("a.fits", "2.tar", resent=True)
+        dbb_ingest_ats.save_entries("dbh", {}, [first, None, resent], 10)
+
+        self.mocks["filename_exists_in_dbb"].assert_not_called()
+        self.mocks["handle_bad_file"].assert_called_once_with({}, "dbh", "2.tar", resent["src_info"],
+                                                              dbb_ingest_ats.DUPLICATE_MSG)
+        self.mocks["save_batch_db"].assert_called_once_with("dbh", {}, [first])
+
+    def test_resent_in_db(self):
+        self.mocks["filename_exists_in_dbb"].return_value = True
+        resent = self.make_entry("a.fits", "2.tar", resent=True)
+        dbb_ingest_ats.save_entries("dbh", {}, [resent], 10)
+
+        self.mocks["filename_exists_in_dbb"].assert_called_once_with("dbh", "a.fits")
+        self.assertEqual(self.mocks["handle_bad_file"].call_args[0][-1], dbb_ingest_ats.DUPLICATE_MSG)
+
+    def test_existing_file_not_ingested(self):
+        first = self.make_entry("a.fits", "1.tar")
+        resent = self.make_entry("b.fits", "2.tar", resent=True)
+        with self.assertLogs(dbb_ingest_ats._log, logging.ERROR):
+            dbb_ingest_ats.save_entries("dbh", {}, [first, resent], 10)
+
+        self.mocks["filename_exists_in_dbb"].assert_called_once_with("dbh", "b.fits")
+        self.assertEqual(self.mocks["handle_bad_file"].call_args[0][-1], resent["exists_msg"])
+
+    def test_batches(self):
+        entries = [self.make_entry("%s.fits" % num, "%s.tar" % num) for num in range(5)]
+        dbb_ingest_ats.save_entries("dbh", {}, entries, 2)
+        self.assertEqual([call[0][2] for call in self.mocks["save_batch_db"].call_args_list],
+                         [entries[0:2], entries[2:4], entries[4:]])
+
+    def test_stopped_before_save(self):
+        entries = [self.make_entry("%s.fits" % num, "%s.tar" % num) for num in range(3)]
+
+        def stopped():
+            yield from entries
+            raise KeyboardInterrupt
+
+        with self.assertLogs(dbb_ingest_ats._log, logging.WARNING), self.assertRaises(KeyboardInterrupt):
+            dbb_ingest_ats.save_entries("dbh", {}, stopped(), 2)
+        self.assertTrue(os.path.exists(entries[0]["fullname"]))
+        self.assertFalse(os.path.exists(entries[2]["fullname"]))
+
+
+if __name__ == "__main__":
+    unittest.main()